@@ -0,0 +1,28 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import IO, Any, Iterator
+
+
+@contextmanager
+def atomic_write(filename: str, mode: str = "w") -> Iterator[IO[Any]]:
+    """
+    Opens a new file to write with mode 'mode' ("w" or "wb") that replaces the file 'filename' when the with block
+    ends, so that readers only ever see the old file or the complete new one:
+        with atomic_write("graph.npz", "wb") as file:
+            np.savez(file, ...)
+    Every writer uses its own temporary file next to 'filename', so threads and processes that write the same file
+    at the same time do not clobber each other (the last one to finish wins). If the block raises, 'filename'
+    is left as it was.
+    """
+    directory, name = os.path.split(os.path.abspath(filename))
+    file = tempfile.NamedTemporaryFile(
+        mode, dir=directory, prefix=name + ".", suffix=".tmp", delete=False
+    )
+    try:
+        with file:
+            yield file
+        os.replace(file.name, filename)
+    except BaseException:
+        os.remove(file.name)
+        raise
@@ -0,0 +1,204 @@
+import os
+import json
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from geographical import Point, Zone
+from typing import Optional
+from graphmaker import DEFAULT_BACKEND, graph_parameters
+from monuments import get_monuments, load_monument_store
+from routes import Routes, find_routes_batch
+from main import (
+    Input,
+    add_instrumentation_arguments,
+    cached_graph,
+    generate_requested_maps,
+    zone_segments,
+)
+from instrumentation import configure
+import instrumentation
+from tiles import TILE_DIR
+
+
+MAP_KINDS = ("segments", "graph", "routes", "all")
+
+
+def read_jobs(filename: str) -> list[Input]:
+    """
+    Reads the jobs of the JSON file "filename", which looks like:
+    {"jobs": [{"zone": [40.53, 0.57, 40.79, 0.90], "maps": "all", "clusters": 100, "epsilon": 30,
+               "start_point": [40.69, 0.65],
+               "files": {"segment_data": "data_EBRE.txt", "segments": "paths_EBRE.png",
+                         "graphPNG": "graph_EBRE.png", "graphKML": "graph_EBRE.kml",
+                         "routesPNG": "routes_EBRE.png", "routesKML": "routes_EBRE.kml",
+                         "monument_data": "monument_data.txt"}}]}
+    where zones are given as [bottom left lat, bottom left lon, top right lat, top right lon] and "maps" is one of
+    MAP_KINDS. "clusters", "epsilon" and "backend" are optional, and only the files needed by "maps" are required.
+    Maps are only written, not opened, unless a job has "display": true. With "incremental": true, only the new pages
+    of the segment data are downloaded and the last graph of the file is updated with them (see incremental.py).
+    With "tiled": true, the segments are taken from the tiles shared by every zone (see tiles.py) and the job
+    needs no "segment_data" file.
+    """
+    with open(filename, "r") as file:
+        jobs = json.load(file)["jobs"]
+    inputs: list[Input] = []
+    for number, job in enumerate(jobs):
+        if job["maps"] not in MAP_KINDS:
+            raise ValueError(f"Job {number}: maps must be one of {MAP_KINDS}")
+        if job["maps"] in ("routes", "all") and "start_point" not in job:
+            raise ValueError(f"Job {number}: routes need a start_point")
+        if job.get("tiled", False) and job.get("incremental", False):
+            raise ValueError(f"Job {number}: tiled jobs cannot be incremental")
+        bl_lat, bl_lon, tr_lat, tr_lon = job["zone"]
+        start_point = Point(*job["start_point"]) if "start_point" in job else None
+        inputs.append(
+            Input(
+                Zone(Point(bl_lat, bl_lon), Point(tr_lat, tr_lon)),
+                job["maps"],
+                job.get("clusters"),
+                job.get("epsilon"),
+                start_point,
+                job["files"],
+                job.get("backend", DEFAULT_BACKEND),
+                job.get("display", False),
+                job.get("incremental", False),
+                job.get("tiled", False),
+            )
+        )
+    return inputs
+
+
+def group_jobs(jobs: list[Input]) -> list[list[Input]]:
+    """
+    Groups the jobs that depend on each other: jobs that use the same segment data file must not download or cache
+    it at the same time, so they go in the same group. All the tiled jobs may share tiles, so they go in the same
+    group too. Groups are independent of each other.
+    """
+    groups: dict[str, list[Input]] = {}
+    for job in jobs:
+        segment_data = os.path.abspath(TILE_DIR if job.tiled else job.files["segment_data"])
+        groups.setdefault(segment_data, []).append(job)
+    return list(groups.values())
+
+
+def route_key(job: Input) -> Optional[tuple]:
+    """
+    Returns what the routes of the job depend on: jobs with the same key have the same graph, zone and monuments,
+    and only their starting points change. Returns None if the job has no routes that can be shared.
+    """
+    if job.requested_maps not in ("routes", "all") or job.incremental:
+        # incremental jobs change their graph, so every one of them must build its own
+        return None
+    p1, p2 = job.map_zone.bottom_left, job.map_zone.top_right
+    clusters, epsilon = graph_parameters(job.clusters, job.epsilon)
+    return (
+        TILE_DIR if job.tiled else os.path.abspath(job.files["segment_data"]),
+        (p1.lat, p1.lon, p2.lat, p2.lon),
+        int(clusters),
+        float(epsilon),
+        job.backend,
+        os.path.abspath(job.files["monument_data"]),
+    )
+
+
+def shared_routes(jobs: list[Input], workers: int = 1) -> dict[int, Routes]:
+    """
+    Finds at once the routes of all the jobs that only differ in their starting point (see route_key), with a
+    single assignment of the monuments to one graph and the shortest path searches of their starting points
+    split among 'workers' processes (see routes.find_routes_batch). Returns the routes of those
+    jobs by their position in 'jobs'. Jobs whose routes could not be found together are left out, so that each
+    one of them finds its own routes (and reports its own error).
+    """
+    batches: dict[tuple, list[int]] = {}
+    for i, job in enumerate(jobs):
+        key = route_key(job)
+        if key is not None:
+            batches.setdefault(key, []).append(i)
+    routes: dict[int, Routes] = {}
+    for positions in batches.values():
+        if len(positions) == 1:
+            continue  # a job alone finds its own routes
+        first = jobs[positions[0]]
+        try:
+            graph = cached_graph(first, zone_segments(first))
+            monuments = get_monuments(first.map_zone, first.files["monument_data"])
+            starts = [jobs[i].start_point for i in positions]
+            batch = find_routes_batch(graph, starts, monuments, workers)
+            for i, job_routes in zip(positions, batch):
+                routes[i] = job_routes
+        except Exception as e:
+            print(f"Could not find the routes of {len(positions)} jobs together, each one will find its own: {e}")
+    return routes
+
+
+def run_group(jobs: list[Input], workers: int = 1) -> list[str]:
+    """
+    Runs the jobs of a group one after the other in the same process, so that they share its caches.
+    The routes of jobs that only differ in their starting point are found together first, on 'workers'
+    processes (see shared_routes).
+    Returns the errors of the jobs that failed (a failed job does not stop the others).
+    """
+    routes = shared_routes(jobs, workers)
+    errors: list[str] = []
+    for i, job in enumerate(jobs):
+        try:
+            generate_requested_maps(job, routes.get(i))
+        except Exception:
+            errors.append(
+                f"Job with segment data {job.files.get('segment_data', TILE_DIR)} failed:\n{traceback.format_exc()}"
+            )
+    return errors
+
+
+def run_jobs(jobs: list[Input], workers: int) -> list[str]:
+    """
+    Runs all the jobs, with independent groups of jobs in parallel on 'workers' processes.
+    Returns the errors of the jobs that failed.
+    """
+    # the monument store is shared by every job, so it is built once before the workers start
+    for monument_data in {job.files["monument_data"] for job in jobs if "monument_data" in job.files}:
+        if os.path.exists(monument_data):
+            load_monument_store(monument_data)
+    groups = group_jobs(jobs)
+    if workers == 1 or len(groups) == 1:
+        return [error for group in groups for error in run_group(group, workers)]
+    # the workers report their stages like this process does
+    settings = (
+        instrumentation.REPORT_FILE,
+        instrumentation.PROFILE_DIR,
+        instrumentation.TRACE_MEMORY,
+    )
+    group_workers = min(workers, len(groups))
+    # every group running at the same time gets its share of the processes for its shortest path searches
+    route_workers = max(1, workers // group_workers)
+    with ProcessPoolExecutor(
+        max_workers=group_workers, initializer=configure, initargs=settings
+    ) as executor:
+        results = executor.map(run_group, groups, repeat(route_workers))
+        return [error for errors in results for error in errors]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Generate the maps of many zones and starting points in one execution."
+    )
+    parser.add_argument("jobs", help="JSON file with the jobs to run")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="number of processes"
+    )
+    add_instrumentation_arguments(parser)
+    arguments = parser.parse_args()
+    configure(arguments.report, arguments.profile_dir, arguments.trace_memory)
+    jobs = read_jobs(arguments.jobs)
+    print(f"Running {len(jobs)} jobs. This might take a while...")
+    errors = run_jobs(jobs, arguments.workers)
+    for error in errors:
+        print(error)
+    print(f"{len(jobs) - len(errors)} of {len(jobs)} jobs finished correctly.")
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+import io
+import os
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import networkx as nx
+from contextlib import redirect_stdout
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+import rendering
+from geographical import Point, Zone
+from segments import Segments, cache_filename, load_segments, show_segments
+from graphmaker import DEFAULT_BACKEND, DEFAULT_CLUSTERS, DEFAULT_EPSILON, make_graph, simplify_graph
+from monuments import Monument, Monuments
+from routes import (
+    MonumentAssignment,
+    Routes,
+    assign_monuments,
+    build_node_index,
+    closest_nodes,
+    export_routes_KML,
+    export_routes_PNG,
+    find_shortest_routes,
+)
+from viewer import export_graph_KML, export_graph_PNG
+
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}  # name: number of segments
+DEFAULT_SCALES = ["10k", "100k"]
+DEFAULT_MONUMENTS = 1000
+BENCHMARK_ZONE = Zone(Point(40.5363713, 0.5739316671), Point(40.79886535, 0.9021482))  # the Ebre zone
+TRACK_LENGTH = 500  # number of segments of each synthetic track
+STEP = 0.0003  # standard deviation in degrees (~30m) of the steps of the synthetic tracks
+REGRESSION_THRESHOLD = 0.10  # relative slowdown over the baseline that is reported as a regression
+MIN_COMPARED_SECONDS = 0.01  # stages faster than this are too noisy to be reported as regressions
+
+
+@dataclass
+class StageResult:
+    seconds: float  # best time of all the repetitions
+    peak_bytes: Optional[int]  # peak memory allocated by the stage, None if it was not measured
+    items: int  # number of things the stage processed
+    unit: str  # what the items are
+
+    @property
+    def throughput(self) -> float:
+        """
+        Returns the number of items processed per second
+        """
+        return self.items / self.seconds if self.seconds > 0 else float("inf")
+
+
+Results = dict[str, dict[str, StageResult]]  # scale: stage: result
+
+
+def synthetic_segments(n: int, zone: Zone, seed: int = 0) -> np.ndarray:
+    """
+    Returns a (n, 4) array of segments in the format lat1, lon1, lat2, lon2, made of random walks inside the zone
+    that look like GPS tracks: the segments of each track are consecutive and join end to start.
+    """
+    rng = np.random.default_rng(seed)
+    p1, p2 = zone.bottom_left, zone.top_right
+    tracks = -(-n // TRACK_LENGTH)
+    starts = rng.uniform([p1.lat, p1.lon], [p2.lat, p2.lon], (tracks, 1, 2))
+    steps = rng.normal(0, STEP, (tracks, TRACK_LENGTH, 2))
+    points = np.concatenate((starts, starts + np.cumsum(steps, axis=1)), axis=1)
+    points = np.clip(points, [p1.lat, p1.lon], [p2.lat, p2.lon])
+    segments = np.concatenate((points[:, :-1], points[:, 1:]), axis=2)
+    return segments.reshape(-1, 4)[:n]
+
+
+def synthetic_monuments(n: int, zone: Zone, seed: int = 0) -> Monuments:
+    """
+    Returns n monuments at random locations inside the zone
+    """
+    rng = np.random.default_rng(seed)
+    p1, p2 = zone.bottom_left, zone.top_right
+    coords = rng.uniform([p1.lat, p1.lon], [p2.lat, p2.lon], (n, 2))
+    return [
+        Monument(f"Monument {i}", Point(lat, lon))
+        for i, (lat, lon) in enumerate(coords.tolist())
+    ]
+
+
+def write_segment_file(filename: str, coords: np.ndarray) -> None:
+    """
+    Writes the segments to the file 'filename' in the format of the downloaded segment data files
+    """
+    np.savetxt(filename, coords, fmt="%.7f, %.7f - %.7f, %.7f")
+
+
+def measure(
+    function: Callable[..., Any],
+    setup: Callable[[], tuple],
+    repeat: int,
+    memory: bool,
+) -> tuple[Any, float, Optional[int]]:
+    """
+    Runs function(*setup()) 'repeat' times and returns the result of the last run, the best time in seconds and,
+    if 'memory' is True, the peak memory allocated by one more run. Setup is not part of the measurements.
+    Memory is measured in a separate run because tracing every allocation slows the function down.
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        arguments = setup()
+        start = time.perf_counter()
+        result = function(*arguments)
+        best = min(best, time.perf_counter() - start)
+    peak = None
+    if memory:
+        arguments = setup()
+        tracemalloc.start()
+        try:
+            function(*arguments)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, best, peak
+
+
+def read_cached_segments(filename: str) -> float:
+    """
+    Loads the segments of 'filename' from their binary cache and reads all of them. The cache is only memory-mapped
+    by load_segments, so without reading the data the time would only be that of opening the file.
+    """
+    return float(np.asarray(load_segments(filename).coords).sum())
+
+
+def quiet_shortest_routes(
+    graph: nx.Graph, start: int, assignment: MonumentAssignment
+) -> Routes:
+    """
+    Returns the same as find_shortest_routes without printing a message for every unreachable monument,
+    which would flood the output of the benchmark
+    """
+    with redirect_stdout(io.StringIO()):
+        return find_shortest_routes(graph, start, assignment)
+
+
+def run_scale(
+    n: int,
+    workdir: str,
+    clusters: int,
+    backend: str,
+    num_monuments: int,
+    repeat: int,
+    memory: bool,
+) -> dict[str, StageResult]:
+    """
+    Runs every stage of the pipeline on n synthetic segments, writing every file in 'workdir'.
+    Returns the result of each stage.
+    """
+    results: dict[str, StageResult] = {}
+
+    def stage(
+        name: str,
+        function: Callable[..., Any],
+        setup: Callable[[], tuple],
+        items: int,
+        unit: str,
+    ) -> Any:
+        result, seconds, peak = measure(function, setup, repeat, memory)
+        results[name] = StageResult(seconds, peak, items, unit)
+        print(f"  {name:<26}{seconds:>10.3f}s")
+        return result
+
+    segment_file = os.path.join(workdir, f"segments_{n}.txt")
+    write_segment_file(segment_file, synthetic_segments(n, BENCHMARK_ZONE))
+
+    def without_cache() -> tuple:
+        if os.path.exists(cache_filename(segment_file)):
+            os.remove(cache_filename(segment_file))
+        return (segment_file,)
+
+    stage("load_segments (parse)", load_segments, without_cache, n, "segments")
+    stage(
+        "load_segments (cached)",
+        read_cached_segments,
+        lambda: (segment_file,),
+        n,
+        "segments",
+    )
+    segments: Segments = load_segments(segment_file)
+    graph: nx.Graph = stage(
+        "make_graph",
+        make_graph,
+        lambda: (segments, clusters, backend),
+        n,
+        "segments",
+    )
+    # simplification changes the graph, so every run gets its own copy
+    nodes = graph.number_of_nodes()
+    graph = stage(
+        "simplify_graph",
+        simplify_graph,
+        lambda: (graph.copy(), DEFAULT_EPSILON),
+        nodes,
+        "nodes",
+    )
+    monuments = synthetic_monuments(num_monuments, BENCHMARK_ZONE)
+    index = build_node_index(graph)
+    assignment = stage(
+        "assign_monuments",
+        assign_monuments,
+        lambda: (graph, monuments, index),
+        num_monuments,
+        "monuments",
+    )
+    center = Point(
+        (BENCHMARK_ZONE.bottom_left.lat + BENCHMARK_ZONE.top_right.lat) / 2,
+        (BENCHMARK_ZONE.bottom_left.lon + BENCHMARK_ZONE.top_right.lon) / 2,
+    )
+    start = closest_nodes(index, [center])[0]
+    routes: Routes = stage(
+        "find_shortest_routes",
+        quiet_shortest_routes,
+        lambda: (graph, start, assignment),
+        len(assignment),
+        "routes",
+    )
+    if len(routes) < len(assignment):
+        print(f"  ({len(assignment) - len(routes)} nodes with monuments cannot be reached)")
+
+    edges = graph.number_of_edges()
+    stage(
+        "show_segments",
+        show_segments,
+        lambda: (segments, os.path.join(workdir, "segments.png"), False),
+        n,
+        "segments",
+    )
+    stage(
+        "export_graph_PNG",
+        export_graph_PNG,
+        lambda: (graph, os.path.join(workdir, "graph.png"), False),
+        edges,
+        "edges",
+    )
+    stage(
+        "export_graph_KML",
+        export_graph_KML,
+        lambda: (graph, os.path.join(workdir, "graph.kml")),
+        edges,
+        "edges",
+    )
+    stage(
+        "export_routes_PNG",
+        export_routes_PNG,
+        lambda: (routes, os.path.join(workdir, "routes.png"), False),
+        len(routes),
+        "routes",
+    )
+    stage(
+        "export_routes_KML",
+        export_routes_KML,
+        lambda: (routes, os.path.join(workdir, "routes.kml")),
+        len(routes),
+        "routes",
+    )
+    return results
+
+
+def run_benchmarks(
+    scales: list[str],
+    clusters: int = DEFAULT_CLUSTERS,
+    backend: str = DEFAULT_BACKEND,
+    num_monuments: int = DEFAULT_MONUMENTS,
+    repeat: int = 1,
+    memory: bool = True,
+) -> Results:
+    """
+    Runs the whole pipeline at each one of the scales (see SCALES) and returns the results of every stage.
+    Nothing is downloaded: maps are drawn without background tiles and every file is written in a temporary
+    directory that is deleted afterwards.
+    """
+    offline, tile_cache = rendering.OFFLINE, rendering.TILE_CACHE_DIR
+    results: Results = {}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            # the maps must not use the tiles of the usual tile cache, or their times would depend on it
+            rendering.OFFLINE = True
+            rendering.TILE_CACHE_DIR = os.path.join(workdir, "tile_cache")
+            for scale in scales:
+                print(f"{scale} segments:")
+                results[scale] = run_scale(
+                    SCALES[scale], workdir, clusters, backend, num_monuments, repeat, memory
+                )
+    finally:
+        rendering.OFFLINE, rendering.TILE_CACHE_DIR = offline, tile_cache
+    return results
+
+
+def save_results(results: Results, filename: str) -> None:
+    """
+    Saves the results to the JSON file 'filename', so that they can be used as a baseline
+    """
+    data = {
+        scale: {
+            name: {
+                "seconds": result.seconds,
+                "peak_bytes": result.peak_bytes,
+                "items": result.items,
+                "unit": result.unit,
+            }
+            for name, result in stages.items()
+        }
+        for scale, stages in results.items()
+    }
+    with open(filename, "w") as file:
+        json.dump(data, file, indent=2)
+
+
+def load_results(filename: str) -> Results:
+    """
+    Loads the results saved with save_results in the file 'filename'
+    """
+    with open(filename, "r") as file:
+        data = json.load(file)
+    return {
+        scale: {name: StageResult(**result) for name, result in stages.items()}
+        for scale, stages in data.items()
+    }
+
+
+def print_results(results: Results) -> None:
+    """
+    Prints the time, throughput and peak memory of every stage
+    """
+    for scale, stages in results.items():
+        print(f"\n{scale} segments")
+        print(f"{'stage':<26}{'seconds':>10}{'throughput':>24}{'peak MB':>10}")
+        for name, result in stages.items():
+            throughput = f"{result.throughput:,.0f} {result.unit}/s"
+            peak = "-" if result.peak_bytes is None else f"{result.peak_bytes / 2**20:.1f}"
+            print(f"{name:<26}{result.seconds:>10.3f}{throughput:>24}{peak:>10}")
+
+
+def compare_results(
+    results: Results, baseline: Results, threshold: float = REGRESSION_THRESHOLD
+) -> list[str]:
+    """
+    Prints how the time of every stage changed with respect to the baseline and returns the stages
+    that got more than 'threshold' (relative) slower. Stages missing from either side are skipped, and stages
+    that take less than MIN_COMPARED_SECONDS are never regressions.
+    """
+    regressions: list[str] = []
+    print(f"\n{'scale':<8}{'stage':<26}{'baseline':>10}{'now':>10}{'change':>10}")
+    for scale, stages in results.items():
+        for name, result in stages.items():
+            if name not in baseline.get(scale, {}):
+                continue
+            before = baseline[scale][name].seconds
+            change = result.seconds / before - 1 if before > 0 else 0.0
+            mark = ""
+            if change > threshold and result.seconds >= MIN_COMPARED_SECONDS:
+                regressions.append(f"{scale} {name}")
+                mark = "  <- slower"
+            print(
+                f"{scale:<8}{name:<26}{before:>10.3f}{result.seconds:>10.3f}{change:>+10.1%}{mark}"
+            )
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Time every stage of the map pipeline on synthetic data, without going online."
+    )
+    parser.add_argument(
+        "--scales", nargs="+", choices=SCALES, default=DEFAULT_SCALES, help="numbers of segments"
+    )
+    parser.add_argument("--clusters", type=int, default=DEFAULT_CLUSTERS)
+    parser.add_argument("--backend", default=DEFAULT_BACKEND)
+    parser.add_argument("--monuments", type=int, default=DEFAULT_MONUMENTS)
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="runs of each stage, the best time is kept"
+    )
+    parser.add_argument(
+        "--no-memory", action="store_true", help="do not measure the peak memory of the stages"
+    )
+    parser.add_argument("--save", help="JSON file to save the results to, to use them as a baseline")
+    parser.add_argument("--compare", help="JSON file with the baseline results to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=REGRESSION_THRESHOLD,
+        help="relative slowdown reported as a regression",
+    )
+    arguments = parser.parse_args()
+    # the files are written in a temporary directory, so the paths must not be relative to it
+    save = os.path.abspath(arguments.save) if arguments.save else None
+    baseline = load_results(arguments.compare) if arguments.compare else None
+
+    results = run_benchmarks(
+        arguments.scales,
+        arguments.clusters,
+        arguments.backend,
+        arguments.monuments,
+        arguments.repeat,
+        not arguments.no_memory,
+    )
+    print_results(results)
+    if save:
+        save_results(results, save)
+    if baseline is not None:
+        regressions = compare_results(results, baseline, arguments.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} stages are slower than the baseline: {', '.join(regressions)}")
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
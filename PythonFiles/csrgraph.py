@@ -0,0 +1,134 @@
+import networkx as nx
+import numpy as np
+from numpy import ndarray
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+from dataclasses import dataclass
+from geographical import Point
+
+
+NO_PREDECESSOR = -9999  # value scipy gives to the predecessor of the source and of unreachable nodes
+
+
+@dataclass(eq=False)
+class CSRGraph:
+    """
+    Undirected weighted graph stored in compressed sparse row form. Nodes are numbered 0..n-1 and
+    the neighbours of node i are indices[indptr[i]:indptr[i + 1]], with the weights of those edges
+    in the same positions of weights. Every edge is stored once in each direction.
+    """
+
+    nodes: ndarray  # name of each node in the networkx graph it comes from
+    coords: ndarray  # (#nodes, 2) array with the latitude and longitude of each node
+    indptr: ndarray
+    indices: ndarray
+    weights: ndarray
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def neighbors(self, i: int) -> ndarray:
+        """
+        Returns the neighbours of node i
+        """
+        return self.indices[self.indptr[i] : self.indptr[i + 1]]
+
+    def edges(self) -> tuple[ndarray, ndarray, ndarray]:
+        """
+        Returns three arrays u, v, w with the edges of the graph (u[k], v[k]) and their weights w[k],
+        each undirected edge only once (with u < v)
+        """
+        sources = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        once = sources < self.indices
+        return sources[once], self.indices[once], self.weights[once]
+
+
+def from_edges(
+    nodes: ndarray, coords: ndarray, u: ndarray, v: ndarray, w: ndarray
+) -> CSRGraph:
+    """
+    Builds a CSR graph whose nodes have the names 'nodes' and coordinates 'coords', with an edge of weight w[k]
+    between the nodes in positions u[k] and v[k].
+    Pre: every edge appears only once, in either direction
+    """
+    sources = np.concatenate((u, v))
+    targets = np.concatenate((v, u))
+    weights = np.concatenate((w, w)).astype(np.float64)
+    order = np.argsort(sources, kind="stable")
+    indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(nodes)), out=indptr[1:])
+    return CSRGraph(
+        np.asarray(nodes),
+        np.asarray(coords, dtype=np.float64).reshape(-1, 2),
+        indptr,
+        targets[order].astype(np.int32),
+        weights[order],
+    )
+
+
+def from_networkx(graph: nx.Graph) -> CSRGraph:
+    """
+    Converts a networkx graph into a CSR graph.
+    Pre: all nodes have a "coord" attribute and all edges a "weight" attribute
+    """
+    nodes = list(graph.nodes())
+    position = {node: i for i, node in enumerate(nodes)}
+    coords = np.array(
+        [[graph.nodes[node]["coord"].lat, graph.nodes[node]["coord"].lon] for node in nodes],
+        dtype=np.float64,
+    )
+    edges = np.array(
+        [[position[a], position[b], weight] for a, b, weight in graph.edges(data="weight")],
+        dtype=np.float64,
+    ).reshape(-1, 3)
+    return from_edges(
+        np.array(nodes),
+        coords,
+        edges[:, 0].astype(np.int64),
+        edges[:, 1].astype(np.int64),
+        edges[:, 2],
+    )
+
+
+def to_networkx(csr: CSRGraph) -> nx.Graph:
+    """
+    Converts a CSR graph into a networkx graph with the same node names. Nodes have a "coord" attribute
+    with their Point and edges have a "weight" attribute.
+    """
+    graph = nx.Graph()
+    for node, (lat, lon) in zip(csr.nodes.tolist(), csr.coords.tolist()):
+        graph.add_node(node, coord=Point(lat, lon))
+    u, v, w = csr.edges()
+    names = csr.nodes.tolist()
+    graph.add_weighted_edges_from(
+        (names[a], names[b], weight) for a, b, weight in zip(u.tolist(), v.tolist(), w.tolist())
+    )
+    return graph
+
+
+def shortest_paths(csr: CSRGraph, sources: list[int]) -> tuple[ndarray, ndarray]:
+    """
+    Runs dijkstra's algorithm from every node in positions 'sources' and returns two (#sources, #nodes) arrays:
+    the distance from each source to every node (inf if it cannot be reached) and the predecessor of every node
+    in the shortest path tree of each source (NO_PREDECESSOR for the source and unreachable nodes).
+    """
+    matrix = csr_matrix(
+        (csr.weights, csr.indices, csr.indptr), shape=(len(csr), len(csr))
+    )
+    distances, predecessors = dijkstra(
+        matrix, directed=True, indices=sources, return_predecessors=True
+    )
+    return distances.reshape(len(sources), -1), predecessors.reshape(len(sources), -1)
+
+
+def path_to(predecessors: ndarray, target: int) -> list[int]:
+    """
+    Returns the positions of the nodes in the path from the source of the shortest path tree 'predecessors'
+    (one row of the result of shortest_paths) to the node in position 'target'.
+    Pre: target is reachable from the source
+    """
+    path = [target]
+    while predecessors[path[-1]] != NO_PREDECESSOR:
+        path.append(int(predecessors[path[-1]]))
+    path.reverse()
+    return path
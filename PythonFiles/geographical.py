@@ -1,14 +1,19 @@
+import math
+import numpy as np
+from numpy import ndarray
 from dataclasses import dataclass
-from haversine import haversine
 
 
-@dataclass
+EARTH_RADIUS = 6371.0088  # mean radius of the Earth in Km
+
+
+@dataclass(slots=True)
 class Point:
     lat: float
     lon: float
 
 
-@dataclass
+@dataclass(slots=True)
 class Zone:
     bottom_left: Point
     top_right: Point
@@ -19,8 +24,36 @@ def distance_between_points(start: Point, end: Point) -> float:
     Returns the distance between two geographical points 'start' and 'end' in Km,
     taking into account the Earth's curvature
     """
-    point1, point2 = (start.lat, start.lon), (end.lat, end.lon)
-    return haversine(point1, point2)
+    lat1, lon1, lat2, lon2 = map(math.radians, (start.lat, start.lon, end.lat, end.lon))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def distances_between_points(starts: ndarray, ends: ndarray) -> ndarray:
+    """
+    Given two (N, 2) arrays of points in the format lat, lon, returns the distance in Km between
+    each point of 'starts' and the point in the same row of 'ends' (see distance_between_points)
+    """
+    lat1, lon1 = np.radians(starts[:, 0]), np.radians(starts[:, 1])
+    lat2, lon2 = np.radians(ends[:, 0]), np.radians(ends[:, 1])
+    a = (
+        np.sin((lat2 - lat1) / 2) ** 2
+        + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    )
+    # rounding errors can make a slightly bigger than 1
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def distances_from_point(start: Point, points: ndarray) -> ndarray:
+    """
+    Returns the distance in Km between 'start' and each point of the (N, 2) array of points 'points'
+    in the format lat, lon
+    """
+    starts = np.broadcast_to(np.array([start.lat, start.lon]), points.shape)
+    return distances_between_points(starts, points)
 
 
 def in_zone(box: Zone, coord: Point) -> bool:
@@ -32,3 +65,16 @@ def in_zone(box: Zone, coord: Point) -> bool:
         box.bottom_left.lat <= coord.lat <= box.top_right.lat
         and box.bottom_left.lon <= coord.lon <= box.top_right.lon
     )
+
+
+def in_zone_mask(box: Zone, lats: ndarray, lons: ndarray) -> ndarray:
+    """
+    Returns a boolean array whose values are True iff the point with the latitude and longitude in the same
+    position of 'lats' and 'lons' is inside the box (see in_zone). Both arrays must have the same shape.
+    """
+    return (
+        (box.bottom_left.lat <= lats)
+        & (lats <= box.top_right.lat)
+        & (box.bottom_left.lon <= lons)
+        & (lons <= box.top_right.lon)
+    )
@@ -0,0 +1,158 @@
+import os
+import json
+import hashlib
+import networkx as nx
+import numpy as np
+from typing import Optional
+import graphmaker
+from graphmaker import DEFAULT_BACKEND, Segments, get_graph, graph_parameters
+from csrgraph import CSRGraph, from_networkx, to_networkx
+from instrumentation import stage
+from atomicfile import atomic_write
+
+
+GRAPH_CACHE_DIR = "graph_cache"  # directory where built graphs are kept between executions
+MAX_CACHE_BYTES = 256 * 1024 * 1024  # the least recently used graphs are deleted above this size
+CHUNK_SIZE = 1024 * 1024  # bytes of the segment file hashed at a time
+CACHE_FORMAT = 2  # changes whenever the graphs are saved differently, so older files are never loaded
+NO_SEGMENTS = -1  # number of segments saved for the edges that have no "segments" attribute
+
+
+def file_digest(filename: str) -> str:
+    """
+    Returns the sha256 hash of the contents of the file 'filename'
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def segments_digest(segments: Segments) -> str:
+    """
+    Returns the sha256 hash of the coordinates of the segments
+    """
+    return hashlib.sha256(np.ascontiguousarray(segments.coords).tobytes()).hexdigest()
+
+
+def cache_key(segment_digest: str, clusters: int, epsilon: float, backend: str) -> str:
+    """
+    Returns the key of the graph built from the segments with hash 'segment_digest' and the given parameters.
+    Everything that changes the graph is part of the key, so a cached graph is never used for different input.
+    """
+    # the same parameters can come as 30 or 30.0 depending on where they were read, and must give the same key
+    parameters = [
+        segment_digest,
+        int(clusters),
+        float(epsilon),
+        graphmaker.MIN_SEGMENTS,
+        backend,
+        CACHE_FORMAT,
+    ]
+    return hashlib.sha256(json.dumps(parameters).encode("utf-8")).hexdigest()
+
+
+def save_graph(graph: nx.Graph, filename: str) -> None:
+    """
+    Saves the graph to the file 'filename' as compressed CSR arrays (see atomic_write), together with the number
+    of segments of every edge (the "segments" attribute, NO_SEGMENTS for edges made by the simplification)
+    """
+    csr = from_networkx(graph)
+    u, v, _ = csr.edges()
+    names = csr.nodes.tolist()
+    edge_segments = np.array(
+        [
+            graph.edges[names[a], names[b]].get("segments", NO_SEGMENTS)
+            for a, b in zip(u.tolist(), v.tolist())
+        ],
+        dtype=np.int64,
+    )
+    with atomic_write(filename, "wb") as file:
+        np.savez_compressed(
+            file,
+            nodes=csr.nodes,
+            coords=csr.coords,
+            indptr=csr.indptr,
+            indices=csr.indices,
+            weights=csr.weights,
+            segments=edge_segments,
+        )
+
+
+def load_graph(filename: str) -> nx.Graph:
+    """
+    Loads a graph saved with save_graph from the file 'filename'
+    """
+    with np.load(filename) as data:
+        csr = CSRGraph(
+            data["nodes"], data["coords"], data["indptr"], data["indices"], data["weights"]
+        )
+        edge_segments = data["segments"]
+    graph = to_networkx(csr)
+    # the edges of csr.edges() are in the same order save_graph found them in
+    u, v, _ = csr.edges()
+    names = csr.nodes.tolist()
+    for a, b, count in zip(u.tolist(), v.tolist(), edge_segments.tolist()):
+        if count != NO_SEGMENTS:
+            graph.edges[names[a], names[b]]["segments"] = count
+    return graph
+
+
+def evict(cache_dir: str, max_bytes: int) -> None:
+    """
+    Deletes the least recently used graphs of the cache until its size is at most 'max_bytes'.
+    Graphs are touched every time they are used, so their modification time is their last use.
+    Other processes can be using and evicting the same cache, so graphs can disappear at any moment.
+    """
+    entries: list[tuple[float, int, str]] = []  # modification time, size, path
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npz"):
+            try:
+                status = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((status.st_mtime, status.st_size, entry.path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        total -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def get_cached_graph(
+    segment_file: Optional[str],
+    segments: Segments,
+    clusters: Optional[int],
+    epsilon: Optional[float],
+    backend: str = DEFAULT_BACKEND,
+    cache_dir: str = GRAPH_CACHE_DIR,
+    max_bytes: int = MAX_CACHE_BYTES,
+) -> nx.Graph:
+    """
+    Returns the same graph as get_graph(segments, clusters, epsilon, backend), where segments are the ones in
+    the file 'segment_file'. If that graph was built before, it is loaded from the cache instead of built again.
+    Segments that do not come from a single file (segment_file is None) are identified by their coordinates.
+    """
+    clusters, epsilon = graph_parameters(clusters, epsilon)
+    digest = (
+        segments_digest(segments) if segment_file is None else file_digest(segment_file)
+    )
+    key = cache_key(digest, clusters, epsilon, backend)
+    filename = os.path.join(cache_dir, key + ".npz")
+    try:
+        os.utime(filename)  # mark it as recently used
+        with stage("load_graph", file=filename):
+            return load_graph(filename)
+    except FileNotFoundError:
+        pass  # never built, or evicted by another process
+    graph = get_graph(segments, clusters, epsilon, backend)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_graph(graph, filename)
+    evict(cache_dir, max_bytes)
+    return graph
@@ -2,30 +2,33 @@ import networkx as nx
 from typing import TypeAlias
 from numpy import ndarray
 import numpy as np
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from segments import *
-from math import acos
-from geographical import Point, distance_between_points
+from geographical import Point, distance_between_points, distances_between_points
+from instrumentation import stage
 
 
 MIN_SEGMENTS = 0  # minimum number of segments that must connect two nodes in order to create an edge between them
 
+DEFAULT_CLUSTERS = 100
+DEFAULT_EPSILON = 30
+
+CLUSTERING_BACKENDS = ("kmeans", "minibatch", "grid")
+DEFAULT_BACKEND = "kmeans"
+BATCH_SIZE = 4096  # number of points in each batch of the minibatch backend
+GRID_CELL = 0.0005  # size in degrees (~50m) of the cells the grid backend snaps points to before clustering
+TOLERANCE = 0.05  # relative excess of inertia over full kmeans that a scalable backend is allowed
+
 
 Edge: TypeAlias = tuple[int, int]  # [centroid1_number, centroid2_number]
 
 
 def modify_for_kmeans(segments: Segments) -> ndarray:  # type:ignore
     """
-    Modifies a list of segments "segments" to a numpy array so that it can be input into a kmeans clustering algorithm
+    Modifies the segments "segments" to a numpy array so that it can be input into a kmeans clustering algorithm.
+    The array is a view of the segment coordinates, so no points are copied.
     """
-    points = np.array(
-        [
-            [point.lat, point.lon]
-            for segment in segments
-            for point in [segment.start, segment.end]
-        ]
-    )
-    return points
+    return segments.endpoints
 
   
 def add_nodes(graph: nx.Graph, centroid_coords: ndarray) -> None:
@@ -35,67 +38,165 @@ def add_nodes(graph: nx.Graph, centroid_coords: ndarray) -> None:
     Prec: the graph is empty
     """
     for centroid, coords in enumerate(centroid_coords):
-        graph.add_node(
-            centroid, coord=Point(float(coords[0]), float(coords[1])), monuments=[]
-        )
+        graph.add_node(centroid, coord=Point(float(coords[0]), float(coords[1])))
         
         
-def add_edges(graph: nx.Graph, point_labels: ndarray) -> None:
+def count_edges(point_labels: ndarray) -> tuple[ndarray, ndarray]:
+    """
+    Returns the pairs of clusters (u, v) with u < v that are joined by at least one segment, using point-labels
+    (a list containing the cluster each point was assigned to), and the number of segments joining each pair.
+    """
+    # the points in positions 0-1 were a segment, as were those in 2-3, 4-5, etc.
+    pairs = np.sort(np.asarray(point_labels).reshape(-1, 2), axis=1)
+    # only segments whose two points were assigned to different clusters join two clusters
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    edges, counts = np.unique(pairs, axis=0, return_counts=True)
+    return edges.reshape(-1, 2), counts
+
+
+def add_edges(graph: nx.Graph, centroid_coords: ndarray, point_labels: ndarray) -> None:
     """
     Adds edges to the graph, using point-labels (a list containing the cluster each point was assigned to)
     to check that there is enough "segments" between two nodes before adding an edge.
+    Edges are weighted with the distance between the centroids they join and keep their number of segments.
     """
-    segment_count: dict[tuple[int, int], int] = {}  # ((u,v), nombre de segments)
-    # the points in positions 0-1 were a segment, as were those in 2-3, 4-5, etc.
-    # thus, we will check for segments between clusters by traversing the list 2 by 2
-    for i in range(0, len(point_labels), 2):
-        p1cluster, p2cluster = point_labels[i], point_labels[i + 1]
-        # if two points joined by a segment were assigned to different clusters, we add a segment between clusters
-        if p1cluster != p2cluster:
-            edge = (min(p1cluster, p2cluster), max(p1cluster, p2cluster))
-            if edge in segment_count:
-                segment_count[edge] += 1
-            else:
-                segment_count[edge] = 1
-            # if there are enough segments between clusters, we add an edge
-            if segment_count[edge] > MIN_SEGMENTS:
-                graph.add_edge(
-                    p1cluster,
-                    p2cluster,
-                    weight=distance_between_points(
-                        graph.nodes[p1cluster]["coord"], graph.nodes[p2cluster]["coord"]
-                    ),
-                )
-
-
-def make_graph(segments: Segments, numclusters: int) -> nx.Graph:  # type:ignore
+    edges, counts = count_edges(point_labels)
+    add_counted_edges(graph, centroid_coords, edges, counts)
+
+
+def add_counted_edges(
+    graph: nx.Graph, centroid_coords: ndarray, edges: ndarray, counts: ndarray
+) -> None:
+    """
+    Adds to the graph the pairs of clusters 'edges' (see count_edges) joined by more than MIN_SEGMENTS segments,
+    where counts[i] is the number of segments joining edges[i].
+    """
+    # if there are enough segments between clusters, we add an edge
+    enough = counts > MIN_SEGMENTS
+    edges, counts = edges[enough], counts[enough]
+    if len(edges) == 0:
+        return
+    weights = distances_between_points(
+        centroid_coords[edges[:, 0]], centroid_coords[edges[:, 1]]
+    )
+    graph.add_edges_from(
+        (u, v, {"weight": weight, "segments": count})
+        for (u, v), weight, count in zip(edges.tolist(), weights.tolist(), counts.tolist())
+    )
+
+
+def snap_to_grid(points: ndarray, cell: float) -> tuple[ndarray, ndarray, ndarray]:
+    """
+    Groups the points by the square grid cell of side 'cell' degrees they fall in. Returns the mean point of each
+    non-empty cell, the number of points in each cell and the cell each point was snapped to.
+    """
+    cells = np.floor(points / cell).astype(np.int64)
+    # a single integer per cell is much faster to sort than a pair of coordinates
+    keys = (cells[:, 0] << 32) + (cells[:, 1] & 0xFFFFFFFF)
+    _, point_cells, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    point_cells = point_cells.reshape(-1)
+    means = np.column_stack(
+        [np.bincount(point_cells, weights=points[:, i]) for i in range(2)]
+    ) / counts[:, None]
+    return means, counts, point_cells
+
+
+def cluster_points(
+    points: ndarray,
+    numclusters: int,
+    backend: str = DEFAULT_BACKEND,
+    batch_size: int = BATCH_SIZE,
+) -> tuple[ndarray, ndarray]:
+    """
+    Clusters the points into "numclusters" clusters and returns the coordinates of the centroids and the cluster
+    each point was assigned to. The backend can be:
+        - "kmeans": full kmeans over every point (the most accurate, but slow and memory hungry for big inputs)
+        - "minibatch": kmeans fitted on batches of 'batch_size' points
+        - "grid": points are first snapped to a grid of GRID_CELL degrees, then the cells are clustered by kmeans
+          weighted by how many points each one has
+    Pre: points is not empty, numclusters is positive
+    """
+    if backend == "kmeans":
+        kmeans = KMeans(n_clusters=numclusters)
+        kmeans.fit(points)
+        return kmeans.cluster_centers_, kmeans.labels_
+    if backend == "minibatch":
+        minibatch = MiniBatchKMeans(n_clusters=numclusters, batch_size=batch_size)
+        minibatch.fit(points)
+        return minibatch.cluster_centers_, minibatch.labels_
+    if backend == "grid":
+        cell_means, cell_counts, point_cells = snap_to_grid(points, GRID_CELL)
+        # there cannot be more clusters than cells
+        kmeans = KMeans(n_clusters=min(numclusters, len(cell_means)))
+        kmeans.fit(cell_means, sample_weight=cell_counts)
+        return kmeans.cluster_centers_, kmeans.labels_[point_cells]
+    raise ValueError(
+        f"Unknown clustering backend '{backend}', choose one of {CLUSTERING_BACKENDS}"
+    )
+
+
+def clustering_inertia(points: ndarray, centroid_coords: ndarray, point_labels: ndarray) -> float:
+    """
+    Returns the sum of the squared distances between every point and the centroid of its cluster
+    """
+    return float(((points - centroid_coords[point_labels]) ** 2).sum())
+
+
+def matches_kmeans(
+    points: ndarray, numclusters: int, backend: str, tolerance: float = TOLERANCE
+) -> bool:
+    """
+    Returns True iff clustering the points with the backend gives an inertia no more than 'tolerance' times
+    worse than the one of full kmeans, which is the reference for how good a clustering is.
+    """
+    reference = clustering_inertia(points, *cluster_points(points, numclusters, "kmeans"))
+    inertia = clustering_inertia(points, *cluster_points(points, numclusters, backend))
+    return inertia <= reference * (1 + tolerance)
+
+
+def make_graph(
+    segments: Segments, numclusters: int, backend: str = DEFAULT_BACKEND
+) -> nx.Graph:  # type:ignore
     """
     Make a graph(V, E) with V a set of "numclusters" nodes which are the result of a clustering of the points in
     segments, and E a set of edges indicating that there are segments joining the points in each cluster.
+    The clustering is done with 'backend' (see cluster_points).
     Pre: segments is not empty, numclusters is positive
     """
     # 1. clustering
-    # modify segments so it can be fit into a kmeans clustering algorithm
+    # modify segments so it can be fit into a clustering algorithm
     points = modify_for_kmeans(segments)
-    kmeans = KMeans(n_clusters=numclusters)
-    kmeans.fit(points)
-    centroid_coords = kmeans.cluster_centers_
-    point_labels = kmeans.labels_
+    with stage("clustering", points=len(points), clusters=numclusters, backend=backend):
+        centroid_coords, point_labels = cluster_points(points, numclusters, backend)
     # 2.create graph, add points and edges
-    graph = nx.Graph()
-    add_nodes(graph, centroid_coords)
-    add_edges(graph, point_labels)
+    with stage("edges"):
+        graph = nx.Graph()
+        add_nodes(graph, centroid_coords)
+        add_edges(graph, centroid_coords, point_labels)
     return graph
   
   
+def angles_between_points(p1: ndarray, p2: ndarray, p3: ndarray) -> ndarray:
+    """
+    Given three (n, 2) arrays with the coordinates of n triples of points, returns the angle in degrees
+    between the points of each triple p1[i] p2[i] and p3[i].
+    If p2[i] is on top of p1[i] or p3[i] the angle is 180: that point adds nothing to the shape of the path.
+    """
+    v1 = p2 - p1
+    v2 = p2 - p3
+    norms = np.linalg.norm(v1, axis=1) * np.linalg.norm(v2, axis=1)
+    dots = (v1 * v2).sum(axis=1)
+    cosines = np.divide(dots, norms, out=np.full(len(norms), -1.0), where=norms > 0)
+    # rounding errors can take the cosine of (almost) straight angles slightly out of [-1, 1]
+    return np.degrees(np.arccos(np.clip(cosines, -1.0, 1.0)))
+
+
 def angle_between_points(p1: Point, p2: Point, p3: Point) -> float:
     """
     Returns the angle in degrees between three points p1 p2 and p3.
     """
-    v1 = np.array([p2.lat - p1.lat, p2.lon - p1.lon])
-    v2 = np.array([p2.lat - p3.lat, p2.lon - p3.lon])
-    angle_rad = acos(np.dot(v1, v2) / (np.linalg.norm(v1) * np.linalg.norm(v2)))
-    return np.degrees(angle_rad)
+    p1s, p2s, p3s = (np.array([[p.lat, p.lon]]) for p in (p1, p2, p3))
+    return float(angles_between_points(p1s, p2s, p3s)[0])
 
   
 def simplify_edge(graph: nx.Graph, n1: int, n2: int, n3: int) -> None:
@@ -114,34 +215,74 @@ def simplify_edge(graph: nx.Graph, n1: int, n2: int, n3: int) -> None:
     )
 
 
+def node_coords(graph: nx.Graph, nodes: list[int]) -> ndarray:
+    """
+    Returns a (len(nodes), 2) array with the coordinates of the nodes
+    """
+    return np.array(
+        [[graph.nodes[node]["coord"].lat, graph.nodes[node]["coord"].lon] for node in nodes]
+    ).reshape(-1, 2)
+
+
 def simplify_graph(graph: nx.Graph, epsilon: float) -> nx.Graph:
     """
     Simplifies the graph. If there is a node n1 of degree 2 (connected to n2 and n3) and the two edges that pass through it
     form an angle bigger than 180 - epsilon, we delete that node and add an edge between the two adjacent nodes.
+    Removing a node changes the angles of its neighbours (and can leave them with degree 2), so they are examined
+    again until no node can be removed. The result does not depend on the order of the nodes in the graph.
     """
-    for node in list(graph.nodes()):
-        if graph.degree(node) == 2:
-            neighbors = list(graph.neighbors(node))
-            u, v = neighbors[0], neighbors[1]
-            if (
-                angle_between_points(
-                    graph.nodes[u]["coord"],
-                    graph.nodes[node]["coord"],
-                    graph.nodes[v]["coord"],
-                )
-                > 180 - epsilon
-            ):
-                simplify_edge(graph, u, node, v)
+    candidates = set(graph.nodes())
+    while candidates:
+        # the nodes are sorted so that ties are always broken the same way
+        nodes = sorted(
+            node for node in candidates if node in graph and graph.degree(node) == 2
+        )
+        neighbors = [tuple(graph.neighbors(node)) for node in nodes]
+        angles = angles_between_points(
+            node_coords(graph, [u for u, _ in neighbors]),
+            node_coords(graph, nodes),
+            node_coords(graph, [v for _, v in neighbors]),
+        )
+        candidates = set()
+        # nodes whose angle is out of date because one of their neighbours has just been removed
+        changed: set[int] = set()
+        # the straightest nodes are removed first
+        for i in np.argsort(-angles, kind="stable"):
+            if angles[i] <= 180 - epsilon:
+                break
+            node, (u, v) = nodes[i], neighbors[i]
+            if node in changed:
+                candidates.add(node)  # it will be examined again with its new neighbours
+                continue
+            simplify_edge(graph, u, node, v)
+            changed.update((u, v))
+            candidates.update((u, v))
     return graph
 
 
+def graph_parameters(
+    clusters: Optional[int], epsilon: Optional[float]
+) -> tuple[int, float]:
+    """
+    Returns the number of clusters and epsilon that a graph requested with 'clusters' and 'epsilon' is built with:
+    the default ones unless both of them are given.
+    """
+    if not clusters or not epsilon:
+        return DEFAULT_CLUSTERS, DEFAULT_EPSILON
+    return clusters, epsilon
+
+
 def get_graph(
-    segments: Segments, clusters: Optional[int], epsilon: Optional[float]
+    segments: Segments,
+    clusters: Optional[int],
+    epsilon: Optional[float],
+    backend: str = DEFAULT_BACKEND,
 ) -> nx.Graph:
     """
-    Returns a networkx graph made from the segments data clustered into a number "clusters" of clusters, with edges
-    that form angles of no more than 180 - epsilon degrees.
+    Returns a networkx graph made from the segments data clustered into a number "clusters" of clusters with the
+    clustering backend 'backend', with edges that form angles of no more than 180 - epsilon degrees.
     """
-    if not clusters or not epsilon:
-        clusters, epsilon = 100, 30
-    return simplify_graph(make_graph(segments, clusters), epsilon)
+    clusters, epsilon = graph_parameters(clusters, epsilon)
+    graph = make_graph(segments, clusters, backend)
+    with stage("simplify", nodes=graph.number_of_nodes()):
+        return simplify_graph(graph, epsilon)
@@ -0,0 +1,176 @@
+import os
+import numpy as np
+import networkx as nx
+from dataclasses import dataclass
+from typing import Optional
+from numpy import ndarray
+from sklearn.metrics import pairwise_distances_argmin
+from graphmaker import (
+    DEFAULT_BACKEND,
+    Segments,
+    add_counted_edges,
+    add_nodes,
+    cluster_points,
+    clustering_inertia,
+    count_edges,
+    graph_parameters,
+    modify_for_kmeans,
+    simplify_graph,
+)
+from instrumentation import stage
+from atomicfile import atomic_write
+
+
+DRIFT_THRESHOLD = 1.5  # the graph is clustered again when new points are this much further from their centroids
+
+
+@dataclass
+class GraphState:
+    """
+    What is needed to add new segments to a graph without clustering all the segments again.
+    Edges are counted before the graph is simplified, so the simplification can be redone after every update.
+    """
+
+    clusters: int  # number of clusters that were requested
+    backend: str  # clustering backend the centroids were found with
+    centroids: ndarray  # (#clusters, 2) coordinates of the centroids
+    edges: ndarray  # (#edges, 2) pairs of clusters (u, v) with u < v joined by at least one segment
+    counts: ndarray  # number of segments joining each pair of edges
+    num_segments: int  # number of segments of the data file the state was built from
+    mean_inertia: float  # mean squared distance between the clustered points and their centroids
+
+
+def state_filename(segment_file: str) -> str:
+    """
+    Returns the name of the file where the graph state of the segment data file 'segment_file' is saved
+    """
+    return os.path.splitext(segment_file)[0] + ".graphstate.npz"
+
+
+def save_state(segment_file: str, state: GraphState) -> None:
+    """
+    Saves the graph state of the segment data file 'segment_file' (see atomic_write)
+    """
+    with atomic_write(state_filename(segment_file), "wb") as file:
+        np.savez(
+            file,
+            clusters=state.clusters,
+            backend=state.backend,
+            centroids=state.centroids,
+            edges=state.edges,
+            counts=state.counts,
+            num_segments=state.num_segments,
+            mean_inertia=state.mean_inertia,
+        )
+
+
+def load_state(segment_file: str) -> Optional[GraphState]:
+    """
+    Returns the graph state saved for the segment data file 'segment_file', or None if it has none
+    """
+    try:
+        with np.load(state_filename(segment_file)) as data:
+            return GraphState(
+                int(data["clusters"]),
+                str(data["backend"]),
+                data["centroids"],
+                data["edges"],
+                data["counts"],
+                int(data["num_segments"]),
+                float(data["mean_inertia"]),
+            )
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def build_state(segments: Segments, clusters: int, backend: str) -> GraphState:
+    """
+    Clusters all the segments from scratch and returns the resulting graph state
+    Pre: segments is not empty, clusters is positive
+    """
+    points = modify_for_kmeans(segments)
+    with stage("clustering", points=len(points), clusters=clusters, backend=backend):
+        centroids, labels = cluster_points(points, clusters, backend)
+    edges, counts = count_edges(labels)
+    inertia = clustering_inertia(points, centroids, labels)
+    return GraphState(
+        clusters, backend, centroids, edges, counts, len(segments), inertia / len(points)
+    )
+
+
+def add_segments(state: GraphState, new_segments: Segments) -> float:
+    """
+    Assigns the endpoints of the new segments to the closest centroid of the state and adds the edges they form
+    to the edge counts, updating the state in place. The centroids do not move.
+    Returns the drift of the new points: their mean squared distance to their centroids divided by that of the
+    points the centroids were found with, so 1 means the clusters fit the new data as well as the old one.
+    """
+    points = modify_for_kmeans(new_segments)
+    labels = pairwise_distances_argmin(points, state.centroids)
+    new_edges, new_counts = count_edges(labels)
+    # edges found in both the old and the new segments add up their counts
+    edges, positions = np.unique(
+        np.vstack((state.edges, new_edges)), axis=0, return_inverse=True
+    )
+    counts = np.bincount(
+        positions.reshape(-1),
+        weights=np.concatenate((state.counts, new_counts)),
+        minlength=len(edges),
+    )
+    state.edges = edges.reshape(-1, 2)
+    state.counts = counts.astype(np.int64)
+    state.num_segments += len(new_segments)
+    new_inertia = clustering_inertia(points, state.centroids, labels) / len(points)
+    if state.mean_inertia == 0:
+        return 1.0 if new_inertia == 0 else float("inf")
+    return new_inertia / state.mean_inertia
+
+
+def state_graph(state: GraphState) -> nx.Graph:
+    """
+    Returns the graph of the state before it is simplified, the same one make_graph would return
+    for the clustering of the state
+    """
+    graph = nx.Graph()
+    add_nodes(graph, state.centroids)
+    add_counted_edges(graph, state.centroids, state.edges, state.counts)
+    return graph
+
+
+def update_graph(
+    segment_file: str,
+    segments: Segments,
+    new_segments: Segments,
+    clusters: Optional[int],
+    epsilon: Optional[float],
+    backend: str = DEFAULT_BACKEND,
+    drift_threshold: float = DRIFT_THRESHOLD,
+) -> nx.Graph:
+    """
+    Returns the graph of the segment data file 'segment_file' (see graphmaker.get_graph), where 'segments' are all
+    its segments and 'new_segments' the ones appended to it since the last call (see download_new_segments).
+    Only the new segments are clustered, by assigning them to the centroids of the last graph of the file. All the
+    segments are clustered again if there is no previous graph with the same parameters, or if the drift of the new
+    points is above 'drift_threshold' (the old centroids no longer describe the data well).
+    Pre: segments is not empty
+    """
+    clusters, epsilon = graph_parameters(clusters, epsilon)
+    state = load_state(segment_file)
+    if (
+        state is None
+        or state.clusters != clusters
+        or state.backend != backend
+        # the state must have been built from exactly the segments that were there before the new ones
+        or state.num_segments + len(new_segments) != len(segments)
+    ):
+        state = build_state(segments, clusters, backend)
+    elif len(new_segments) > 0:
+        with stage("edges", new_segments=len(new_segments)):
+            drift = add_segments(state, new_segments)
+        if drift > drift_threshold:
+            print(f"The new segments drifted {drift:.2f}x from the clusters, clustering them again")
+            state = build_state(segments, clusters, backend)
+    save_state(segment_file, state)
+    graph = state_graph(state)
+    with stage("simplify", nodes=graph.number_of_nodes()):
+        return simplify_graph(graph, epsilon)
@@ -0,0 +1,192 @@
+import os
+import platform
+import re
+import json
+import time
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from typing import Any, Callable, Iterator, Optional, TypeVar
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None  # type: ignore
+
+
+REPORT_FILE: Optional[str] = None  # JSON lines file every stage is reported to, None to not report stages
+PROFILE_DIR: Optional[str] = None  # directory where a cProfile dump of every stage is saved, None to not profile
+TRACE_MEMORY = False  # if True, the peak memory allocated by each stage is measured with tracemalloc (slower)
+
+report_lock = threading.Lock()
+tracing_lock = threading.Lock()
+traced_stages: dict[int, tuple[int, int]] = {}  # stage measuring memory: traced bytes at its start, peak
+tracing_counter = 0  # makes the keys of traced_stages unique
+# only one profiler can run at a time in the whole process (since python 3.12 they all share sys.monitoring)
+profiling_lock = threading.Lock()
+profile_counter = 0  # makes the names of the profile dumps unique
+
+Function = TypeVar("Function", bound=Callable[..., Any])
+
+
+def configure(
+    report_file: Optional[str] = None,
+    profile_dir: Optional[str] = None,
+    trace_memory: bool = False,
+) -> None:
+    """
+    Sets where the stages are reported to (see REPORT_FILE, PROFILE_DIR and TRACE_MEMORY).
+    Without a report file nor a profile directory, stages are not measured at all.
+    """
+    global REPORT_FILE, PROFILE_DIR, TRACE_MEMORY
+    REPORT_FILE, PROFILE_DIR, TRACE_MEMORY = report_file, profile_dir, trace_memory
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+
+
+def max_rss_kb() -> Optional[int]:
+    """
+    Returns the most memory in KB the process has used so far, or None if it cannot be known
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS gives it in bytes, the rest in kilobytes
+    return usage // 1024 if platform.system() == "Darwin" else usage
+
+
+def record_peak() -> None:
+    """
+    Updates the highest peak seen by every stage that is measuring memory with the current peak
+    Pre: tracing_lock is held
+    """
+    peak = tracemalloc.get_traced_memory()[1]
+    for key, (start, highest) in traced_stages.items():
+        traced_stages[key] = (start, max(highest, peak))
+
+
+def start_tracing() -> int:
+    """
+    Starts measuring memory for a stage and returns the key to stop it with (see stop_tracing).
+    Stages can overlap (in different threads or inside each other), so tracemalloc is only started by the first
+    one and stopped by the last one, and the peak of every stage is kept before a new stage resets it.
+    """
+    global tracing_counter
+    with tracing_lock:
+        if not traced_stages:
+            tracemalloc.start()
+        record_peak()
+        tracemalloc.reset_peak()
+        tracing_counter += 1
+        current = tracemalloc.get_traced_memory()[0]
+        traced_stages[tracing_counter] = (current, current)
+        return tracing_counter
+
+
+def stop_tracing(key: int) -> int:
+    """
+    Stops measuring the memory of the stage 'key' and returns the most memory allocated during the stage
+    on top of what was allocated when it started
+    """
+    with tracing_lock:
+        record_peak()
+        start, highest = traced_stages.pop(key)
+        if not traced_stages:
+            tracemalloc.stop()
+    return highest - start
+
+
+def profile_filename(name: str) -> str:
+    """
+    Returns a new file name in PROFILE_DIR for the profile of the stage 'name'
+    """
+    global profile_counter
+    with report_lock:
+        profile_counter += 1
+        number = profile_counter
+    safe_name = re.sub(r"[^\w.-]", "_", name)
+    assert PROFILE_DIR is not None
+    return os.path.join(PROFILE_DIR, f"{safe_name}.{os.getpid()}.{number}.prof")
+
+
+def report(record: dict[str, Any]) -> None:
+    """
+    Appends the record of a stage to the report file as a line of JSON
+    """
+    if REPORT_FILE is None:
+        return
+    line = json.dumps(record) + "\n"
+    # stages of different threads and processes can finish at the same time, so every line is a single write
+    with report_lock, open(REPORT_FILE, "a") as file:
+        file.write(line)
+
+
+@contextmanager
+def stage(name: str, **details: Any) -> Iterator[None]:
+    """
+    Measures the code inside a with block as the stage 'name' of the program:
+        with stage("clustering", points=len(points)):
+            ...
+    The time, the memory used by the process and, if TRACE_MEMORY is True, the peak memory allocated during the
+    stage (on top of what was allocated before) are reported to REPORT_FILE together with 'details'.
+    If PROFILE_DIR is set, the stage is also profiled into its own file. Only one stage is profiled at a time:
+    stages that start while another one is being profiled (inside it or in another thread) are reported with
+    no profile. Memory peaks of stages that run at the same time include the allocations of each other.
+    """
+    if REPORT_FILE is None and PROFILE_DIR is None:
+        yield
+        return
+    profiler = None
+    if PROFILE_DIR is not None and profiling_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+    tracing_key = start_tracing() if TRACE_MEMORY else None
+    started = time.time()
+    start = time.perf_counter()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler that is not a stage (like python -m cProfile) is already running
+            profiler = None
+            profiling_lock.release()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        seconds = time.perf_counter() - start
+        peak_bytes = None if tracing_key is None else stop_tracing(tracing_key)
+        record = {
+            "stage": name,
+            "started": started,
+            "seconds": seconds,
+            "max_rss_kb": max_rss_kb(),
+            "peak_bytes": peak_bytes,
+            "pid": os.getpid(),
+            "thread": threading.current_thread().name,
+            **details,
+        }
+        if PROFILE_DIR is not None:
+            record["profile"] = None
+        if profiler is not None:
+            try:
+                record["profile"] = profile_filename(name)
+                profiler.dump_stats(record["profile"])
+            finally:
+                profiling_lock.release()
+        report(record)
+
+
+def instrumented(function: Function) -> Function:
+    """
+    Decorator that measures every call of the function as a stage named like the function (see stage)
+    """
+
+    @wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with stage(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper  # type: ignore
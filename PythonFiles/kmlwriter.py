@@ -0,0 +1,105 @@
+import io
+import zipfile
+from types import TracebackType
+from typing import Optional, TextIO
+from xml.sax.saxutils import escape
+
+
+KMZ_DOCUMENT = "doc.kml"  # name of the KML document inside a KMZ file
+
+
+def kml_color(red: int, green: int, blue: int, alpha: int = 255) -> str:
+    """
+    Returns a colour in the format KML uses: aabbggrr in hexadecimal
+    """
+    return f"{alpha:02x}{blue:02x}{green:02x}{red:02x}"
+
+
+def coords_string(coords: list[tuple[float, float]]) -> str:
+    """
+    Returns the (lon, lat) points 'coords' in the format of a KML coordinates element
+    """
+    return " ".join(f"{lon},{lat}" for lon, lat in coords)
+
+
+class KMLWriter:
+    """
+    Writes a KML document placemark by placemark, without keeping the document in memory.
+    Styles are defined once and shared by all the placemarks that use them. If the filename ends in .kmz,
+    the document is compressed into a KMZ file. Use it as a context manager:
+        with KMLWriter("routes.kml") as kml:
+            kml.add_style("route", kml_color(254, 130, 140), 3)
+            kml.add_linestring("Route", [(0.65, 40.69), (0.66, 40.70)], "route")
+    """
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.archive: Optional[zipfile.ZipFile] = None
+        self.file: Optional[TextIO] = None
+
+    def __enter__(self) -> "KMLWriter":
+        if self.filename.lower().endswith(".kmz"):
+            self.archive = zipfile.ZipFile(self.filename, "w", zipfile.ZIP_DEFLATED)
+            self.file = io.TextIOWrapper(
+                self.archive.open(KMZ_DOCUMENT, "w"), encoding="utf-8"
+            )
+        else:
+            self.file = open(self.filename, "w", encoding="utf-8")
+        self.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<kml xmlns="http://www.opengis.net/kml/2.2">\n<Document>\n'
+        )
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.write("</Document>\n</kml>\n")
+        assert self.file is not None
+        self.file.close()
+        if self.archive is not None:
+            self.archive.close()
+
+    def write(self, text: str) -> None:
+        assert self.file is not None
+        self.file.write(text)
+
+    def add_style(self, style_id: str, color: str, width: float = 1) -> None:
+        """
+        Defines the line style 'style_id' with colour 'color' (see kml_color) and width 'width'
+        """
+        self.write(
+            f'<Style id="{escape(style_id)}"><LineStyle><color>{color}</color>'
+            f"<width>{width}</width></LineStyle></Style>\n"
+        )
+
+    def add_point(self, name: str, coord: tuple[float, float]) -> None:
+        """
+        Adds a point named 'name' at the (lon, lat) coordinates 'coord'
+        """
+        self.write(
+            f"<Placemark><name>{escape(name)}</name>"
+            f"<Point><coordinates>{coords_string([coord])}</coordinates></Point></Placemark>\n"
+        )
+
+    def add_linestring(
+        self,
+        name: str,
+        coords: list[tuple[float, float]],
+        style_id: str,
+        description: Optional[str] = None,
+    ) -> None:
+        """
+        Adds a line named 'name' through the (lon, lat) points 'coords', drawn with the style 'style_id'
+        """
+        description_element = (
+            f"<description>{escape(description)}</description>" if description else ""
+        )
+        self.write(
+            f"<Placemark><name>{escape(name)}</name>{description_element}"
+            f"<styleUrl>#{escape(style_id)}</styleUrl>"
+            f"<LineString><coordinates>{coords_string(coords)}</coordinates></LineString></Placemark>\n"
+        )
@@ -5,8 +5,17 @@ from yogi import *
 from graphmaker import *
 from dataclasses import dataclass
 import webbrowser
+from concurrent.futures import Future, ThreadPoolExecutor
 from routes import *
 from monuments import *
+from graphcache import get_cached_graph
+from incremental import update_graph
+from tiles import get_zone_segments
+import argparse
+from instrumentation import configure, stage
+
+
+RENDER_WORKERS = 3  # number of PNG maps that can be rendered at the same time
 
 
 @dataclass
@@ -20,44 +29,112 @@ class Input:
     files: dict[
         str, str
     ]  # keys: segment_data, segments, graphPNG, graphKML, routesPNG, routesKML, monument_data
+    backend: str = DEFAULT_BACKEND  # clustering backend used to build the graph (see graphmaker.cluster_points)
+    display: bool = True  # False to only write the PNG maps, without opening them
+    incremental: bool = False  # True to fetch the new pages of the segment data and update the graph with them
+    tiled: bool = False  # True to assemble the segments from the shared tiles instead of the segment data file
+
+
+def zone_segments(settings: Input) -> Segments:
+    """
+    Returns the segments of the zone of the settings, downloading them if needed
+    """
+    if settings.tiled:
+        # zones that overlap share the tiles they have in common
+        return get_zone_segments(settings.map_zone)
+    return get_segments(settings.map_zone, settings.files["segment_data"])
+
+
+def cached_graph(settings: Input, segments: Segments) -> nx.Graph:
+    """
+    Returns the graph of the settings made from the segments of their zone. The graph is only built if the same
+    one is not in the cache already.
+    """
+    return get_cached_graph(
+        None if settings.tiled else settings.files["segment_data"],
+        segments,
+        settings.clusters,
+        settings.epsilon,
+        settings.backend,
+    )
 
 
-def generate_requested_maps(settings: Input) -> None:
-    """
-    Generates and shows the requested maps according to the settings input by the user
-    """
-    # we will need to get the segments no matter what map we want to show:
-    segments = get_segments(settings.map_zone, settings.files["segment_data"])
-    assert segments != []
-
-    if settings.requested_maps in ("all", "segments"):
-        # we need to show the segments
-        show_segments(
-            segments,
-            settings.files["segments"],
-        )
-
-    if settings.requested_maps != "segments":
-        # we either needd to generate routes, all or graph maps
-        # we need a graph in any case
-        graph = get_graph(
-            segments,
-            settings.clusters,
-            settings.epsilon,
-        )
-        # do we need to show the graph?
-        if settings.requested_maps in ("graph", "all"):
-            export_graph_PNG(graph, settings.files["graphPNG"])
-            export_graph_KML(graph, settings.files["graphKML"])
-        # do we need to generate and show routes?
-        if settings.requested_maps in ("routes", "all"):
-            assert settings.start_point
-            monuments: Monuments = get_monuments(
-                settings.map_zone, settings.files["monument_data"]
+def generate_requested_maps(settings: Input, routes: Optional[Routes] = None) -> None:
+    """
+    Generates and shows the requested maps according to the settings input by the user.
+    If the routes of the settings were already found (see batch.shared_routes), they can be given in 'routes'.
+    """
+    # PNG maps are rendered in the background while the rest of the maps are computed
+    with ThreadPoolExecutor(max_workers=RENDER_WORKERS) as renders:
+        pending: list[Future] = []
+        if settings.incremental:
+            # only the pages published since the last download are fetched
+            with stage("download", file=settings.files["segment_data"]):
+                new_segments = download_new_segments(
+                    settings.map_zone, settings.files["segment_data"]
+                )
+        # we will need to get the segments no matter what map we want to show:
+        segments = zone_segments(settings)
+        assert len(segments) > 0
+
+        if settings.requested_maps in ("all", "segments"):
+            # we need to show the segments
+            pending.append(
+                renders.submit(
+                    show_segments,
+                    segments,
+                    settings.files["segments"],
+                    settings.display,
+                )
             )
-            routes = find_routes(graph, settings.start_point, monuments)
-            export_routes_PNG(routes, settings.files["routesPNG"])
-            export_routes_KML(routes, settings.files["routesKML"])
+
+        if settings.requested_maps != "segments":
+            # we either needd to generate routes, all or graph maps
+            # we need a graph in any case
+            if settings.incremental:
+                # the new segments are added to the clusters of the last graph of this file
+                graph = update_graph(
+                    settings.files["segment_data"],
+                    segments,
+                    new_segments,
+                    settings.clusters,
+                    settings.epsilon,
+                    settings.backend,
+                )
+            else:
+                graph = cached_graph(settings, segments)
+            # do we need to show the graph?
+            if settings.requested_maps in ("graph", "all"):
+                pending.append(
+                    renders.submit(
+                        export_graph_PNG,
+                        graph,
+                        settings.files["graphPNG"],
+                        settings.display,
+                    )
+                )
+                export_graph_KML(graph, settings.files["graphKML"])
+            # do we need to generate and show routes?
+            if settings.requested_maps in ("routes", "all"):
+                assert settings.start_point
+                if routes is None:
+                    with stage("monuments", file=settings.files["monument_data"]):
+                        monuments: Monuments = get_monuments(
+                            settings.map_zone, settings.files["monument_data"]
+                        )
+                    routes = find_routes(graph, settings.start_point, monuments)
+                pending.append(
+                    renders.submit(
+                        export_routes_PNG,
+                        routes,
+                        settings.files["routesPNG"],
+                        settings.display,
+                    )
+                )
+                export_routes_KML(routes, settings.files["routesKML"])
+        # make any error of the renders show up here
+        for render in pending:
+            render.result()
 
 
 def read_zone() -> Zone:
@@ -221,7 +298,28 @@ def print_welcome_message() -> None:
     )
 
 
+def add_instrumentation_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds to the parser the options that configure the instrumentation of the stages (see instrumentation.configure)
+    """
+    parser.add_argument(
+        "--report", help="JSON lines file to report the time and memory of every stage to"
+    )
+    parser.add_argument(
+        "--profile-dir", help="directory to save a cProfile dump of every stage to"
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="measure the peak memory allocated by every stage (slower)",
+    )
+
+
 def main() -> None:
+    parser = argparse.ArgumentParser(description="Generate route maps of a zone.")
+    add_instrumentation_arguments(parser)
+    arguments = parser.parse_args()
+    configure(arguments.report, arguments.profile_dir, arguments.trace_memory)
     print_welcome_message()
     settings = read_input()
     print(f"\nGenarating your maps. This might take a while...")
@@ -3,8 +3,12 @@ from typing import TypeAlias
 import requests
 from bs4 import BeautifulSoup, Tag
 import os
+import threading
+import numpy as np
+from numpy import ndarray
 import re
 from geographical import *
+from atomicfile import atomic_write
 
 
 @dataclass
@@ -66,22 +70,97 @@ def find_monuments() -> Tag | None:
                 raise
 
 
+@dataclass(eq=False)
+class MonumentStore:
+    """
+    All the monuments of a monument data file, sorted by latitude so that the monuments in a zone can be found
+    with a binary search instead of checking every one of them.
+    """
+
+    names: ndarray  # name of each monument
+    coords: ndarray  # (#monuments, 2) array with the latitude and longitude of each monument
+
+
+loaded_stores: dict[str, tuple[float, MonumentStore]] = {}  # filename: (modification time, store)
+store_locks: dict[str, threading.Lock] = {}  # filename: lock held while its store is being loaded
+store_locks_lock = threading.Lock()
+
+
+def store_filename(filename: str) -> str:
+    """
+    Returns the name of the file where the monument store of the monument data file 'filename' is saved
+    """
+    return os.path.splitext(filename)[0] + ".npz"
+
+
+def parse_monuments(filename: str) -> MonumentStore:
+    """
+    Reads all the monuments of the file "filename" and returns them as a monument store.
+    Pre: every line in the file follows the format: monument name: latitude, longitude
+    """
+    names: list[str] = []
+    coords: list[tuple[float, float]] = []
+    with open(filename, "r") as file:
+        for line in file:
+            # every line in the file is "name: latitude, longitude", and names can contain ":" too
+            name, coord_str = line.rsplit(":", 1)
+            lat, lon = coord_str.split(",")
+            names.append(name)
+            coords.append((float(lat), float(lon)))  # lat and lon were strings
+    order = np.argsort([lat for lat, _ in coords], kind="stable")
+    return MonumentStore(
+        np.array(names, dtype=str)[order],
+        np.array(coords, dtype=np.float64).reshape(-1, 2)[order],
+    )
+
+
+def load_monument_store(filename: str) -> MonumentStore:
+    """
+    Returns the monument store of the file "filename". The text file is only parsed the first time (or after it
+    changes): the store is saved next to it and kept in memory for the next calls.
+    Threads that need the same store at the same time wait for the first one to load it.
+    """
+    with store_locks_lock:
+        lock = store_locks.setdefault(filename, threading.Lock())
+    with lock:
+        modified = os.path.getmtime(filename)
+        if filename in loaded_stores and loaded_stores[filename][0] == modified:
+            return loaded_stores[filename][1]
+        saved = store_filename(filename)
+        if os.path.exists(saved) and os.path.getmtime(saved) >= modified:
+            with np.load(saved) as data:
+                store = MonumentStore(data["names"], data["coords"])
+        else:
+            store = parse_monuments(filename)
+            # other processes can be saving the same store at the same time
+            with atomic_write(saved, "wb") as file:
+                np.savez(file, names=store.names, coords=store.coords)
+        loaded_stores[filename] = (modified, store)
+        return store
+
+
+def query_zone(store: MonumentStore, box: Zone) -> Monuments:
+    """
+    Returns the monuments of the store that are inside the geographical box
+    """
+    # the monuments are sorted by latitude, so the ones in the latitude range of the box are contiguous
+    lats = store.coords[:, 0]
+    first = np.searchsorted(lats, box.bottom_left.lat, side="left")
+    last = np.searchsorted(lats, box.top_right.lat, side="right")
+    inside = first + np.flatnonzero(
+        in_zone_mask(box, store.coords[first:last, 0], store.coords[first:last, 1])
+    )
+    return [
+        Monument(str(store.names[i]), Point(*store.coords[i].tolist())) for i in inside
+    ]
+
+
 def load_monuments(box: Zone, filename: str) -> Monuments:
     """
     Load information of monuments in the geographical box from the file "filename".
     Pre: every line in the file follows the format: monument name: latitude, longitude
     """
-    file = open(filename, "r")
-    monuments: list[Monument] = []
-    for line in file:
-        # every line in the file is "name: latitude, longitude"
-        name, coord_str = line.split(":")
-        lat, lon = coord_str.split(",")
-        coord = Point(float(lat), float(lon))  # lat and lon were strings
-        if in_zone(box, coord):
-            monuments.append(Monument(name, coord))
-    file.close()
-    return monuments
+    return query_zone(load_monument_store(filename), box)
 
 
 def get_monuments(box: Zone, filename: str) -> Monuments:
@@ -0,0 +1,103 @@
+import os
+import hashlib
+import requests
+import numpy as np
+from io import BytesIO
+from numpy import ndarray
+from PIL import Image
+from staticmap import StaticMap
+from atomicfile import atomic_write
+
+
+TILE_CACHE_DIR = "tile_cache"  # directory where map tiles are kept between executions
+OFFLINE = False  # if True, maps only use the tiles already in the cache and never go online
+MAP_WIDTH, MAP_HEIGHT = 800, 600
+TILE_SIZE = 256
+
+
+class CachedStaticMap(StaticMap):
+    """
+    A staticmap map that keeps every tile it downloads in a directory and never downloads the same tile twice.
+    With offline=True nothing is downloaded: tiles that are not in the directory are drawn blank, so maps
+    can be rendered without a network from tiles saved beforehand. Tiles that cannot be downloaded are blank too.
+    """
+
+    def __init__(
+        self,
+        width: int = MAP_WIDTH,
+        height: int = MAP_HEIGHT,
+        cache_dir: str = TILE_CACHE_DIR,
+        offline: bool = False,
+        **kwargs,
+    ) -> None:
+        super().__init__(width, height, tile_size=TILE_SIZE, **kwargs)
+        self.cache_dir = cache_dir
+        self.offline = offline
+
+    def tile_filename(self, url: str) -> str:
+        """
+        Returns the name of the file where the tile with url 'url' is saved
+        """
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest() + ".png"
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, url: str, **kwargs) -> tuple[int, bytes]:
+        """
+        Returns the status code and content of the tile with url 'url', from the cache if possible
+        """
+        filename = self.tile_filename(url)
+        if os.path.exists(filename):
+            with open(filename, "rb") as file:
+                return 200, file.read()
+        if self.offline:
+            return 200, blank_tile()
+        try:
+            status, content = super().get(url, **kwargs)
+        except requests.RequestException:
+            status, content = None, b""
+        if status != 200:
+            # a map without some background tiles is better than no map at all
+            print(f"Could not download the map tile {url}, it will be left blank")
+            return 200, blank_tile()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # several maps can be rendered at the same time
+        with atomic_write(filename, "wb") as file:
+            file.write(content)
+        return status, content
+
+
+def blank_tile() -> bytes:
+    """
+    Returns a white PNG tile
+    """
+    image = Image.new("RGB", (TILE_SIZE, TILE_SIZE), "white")
+    buffer = BytesIO()
+    image.save(buffer, format="png")
+    return buffer.getvalue()
+
+
+def new_static_map() -> CachedStaticMap:
+    """
+    Returns an empty map whose tiles come from the tile cache
+    """
+    return CachedStaticMap(cache_dir=TILE_CACHE_DIR, offline=OFFLINE)
+
+
+def merge_into_polylines(coords: ndarray) -> list[list[tuple[float, float]]]:
+    """
+    Given a (#segments, 4) array of segments in the format lat1, lon1, lat2, lon2, joins every run of consecutive
+    segments where each one starts where the previous one ends into a single polyline. Returns the polylines as
+    lists of (lon, lat) points, which is what staticmap expects.
+    """
+    if len(coords) == 0:
+        return []
+    # segments are saved in chronological order, so the segments of a track are consecutive
+    joined = np.all(coords[1:, :2] == coords[:-1, 2:], axis=1)
+    starts = np.concatenate(([0], np.flatnonzero(~joined) + 1))
+    ends = np.concatenate((starts[1:], [len(coords)]))
+    polylines: list[list[tuple[float, float]]] = []
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        points = np.vstack((coords[start, :2], coords[start:end, 2:]))
+        # staticmap wants (lon, lat)
+        polylines.append([(lon, lat) for lat, lon in points.tolist()])
+    return polylines
@@ -1,10 +1,19 @@
-import simplekml
 import networkx as nx
-from geographical import Point, distance_between_points
+import numpy as np
+from sklearn.neighbors import BallTree
+from typing import Optional, TypeAlias
+from itertools import repeat
+from numpy import ndarray
+from concurrent.futures import ProcessPoolExecutor
+from csrgraph import CSRGraph, from_networkx, path_to, shortest_paths
+from geographical import Point
 from dataclasses import dataclass
 from monuments import Monuments
 from staticmap import *
-from viewer import display_map
+from viewer import save_map
+from rendering import new_static_map
+from kmlwriter import KMLWriter, kml_color
+from instrumentation import instrumented, stage
 
 
 @dataclass
@@ -16,6 +25,36 @@ class Route:
       
 
 Routes = list[Route]
+MonumentAssignment: TypeAlias = dict[int, Monuments]  # node of the graph: monuments closest to that node
+
+
+@dataclass
+class NodeIndex:
+    tree: BallTree  # ball tree over the (lat, lon) coordinates of the nodes, in radians
+    nodes: list[int]  # node of the graph that corresponds to each point in the tree
+
+
+def build_node_index(graph: nx.Graph) -> NodeIndex:
+    """
+    Builds a spatial index of the nodes of the graph to find the closest node to any point quickly.
+    Pre: the graph is not empty and all nodes have a "coord" attribute
+    """
+    nodes = list(graph.nodes())
+    coords = np.array(
+        [[graph.nodes[node]["coord"].lat, graph.nodes[node]["coord"].lon] for node in nodes]
+    )
+    return NodeIndex(BallTree(np.radians(coords), metric="haversine"), nodes)
+
+
+def closest_nodes(index: NodeIndex, points: list[Point]) -> list[int]:
+    """
+    Returns the closest node of the index to each one of the points, all of them found in a single query.
+    """
+    if not points:
+        return []
+    coords = np.radians([[point.lat, point.lon] for point in points])
+    positions = index.tree.query(coords, k=1, return_distance=False)
+    return [index.nodes[position] for position in positions[:, 0]]
 
 
 def search_for_closest_node(graph: nx.Graph, point: Point) -> int:
@@ -23,59 +62,64 @@ def search_for_closest_node(graph: nx.Graph, point: Point) -> int:
     Returns the closest node to the point.
     Pre: all nodes are integers and have a "coord" attribute
     """
-    min_dist, closest_node = -1.0, 0
-    for node in graph.nodes():
-        # check types
-        point2 = graph.nodes[node]["coord"]
-        distance = distance_between_points(point, point2)
-        if distance < min_dist or min_dist == -1.0:
-            min_dist, closest_node = distance, node
-    return closest_node
+    return closest_nodes(build_node_index(graph), [point])[0]
 
 
-def assign_monuments(graph: nx.Graph, endpoints: Monuments) -> None:
+def assign_monuments(
+    graph: nx.Graph, endpoints: Monuments, index: Optional[NodeIndex] = None
+) -> MonumentAssignment:
     """
-    Assign each monument to its closest point in the graph.
-    Pre: all nodes in the graph have an attribute "monuments"
+    Assign each monument to its closest point in the graph and return the monuments assigned to each node
+    (nodes without monuments are not in the result). The closest nodes are looked up in 'index', which
+    is built if it is not given. The graph is not modified, so the same graph can be shared by many searches.
     """
-    for monument in endpoints:
-        closest_node = search_for_closest_node(graph, monument.location)
-        graph.nodes[closest_node]["monuments"].append(monument)
-        
+    if index is None:
+        index = build_node_index(graph)
+    assignment: MonumentAssignment = {}
+    locations = [monument.location for monument in endpoints]
+    for monument, closest_node in zip(endpoints, closest_nodes(index, locations)):
+        assignment.setdefault(closest_node, []).append(monument)
+    return assignment
+
 
-def compute_total_distance(graph: nx.Graph, path: list[int]) -> float:
+def reconstruct_path(predecessors: dict[int, list[int]], target: int) -> list[int]:
     """
-    Computes the total lenght (sum of weights) of the path (list of nodes) in the weighted graph 'graph'.
+    Returns the path (list of nodes) from the source of a shortest path tree to 'target', following the
+    predecessors of each node back to the source.
+    Pre: target is reachable from the source
     """
-    return sum(graph[path[i]][path[i + 1]]["weight"] for i in range(len(path) - 1))
+    path = [target]
+    while predecessors[path[-1]]:
+        # if several shortest paths exist, any of them will do
+        path.append(predecessors[path[-1]][0])
+    path.reverse()
+    return path
 
 
-def find_shortest_routes(graph: nx.Graph, start: int) -> Routes:
+def find_shortest_routes(
+    graph: nx.Graph, start: int, assignment: MonumentAssignment
+) -> Routes:
     """
-    Find the shortest routes from the start point to each monument on the graph.
+    Find the shortest routes from the start point to each node of the graph with monuments assigned.
     """
-    targets = [node for node in graph.nodes() if graph.nodes[node]["monuments"]]
+    targets = [node for node in graph.nodes() if node in assignment]
+    # a single run of dijkstra's algorithm gives the shortest paths from start to every node containing monuments
+    predecessors, distances = nx.dijkstra_predecessor_and_distance(
+        graph, start, weight="weight"
+    )
+    start_point: Point = graph.nodes[start]["coord"]
     routes = []
-    # use dijkstra's algorithm to find shortest paths from start to each node containig monuments
     for target in targets:
-        try:
-            path = nx.dijkstra_path(graph, source=start, target=target, weight="weight")
-            start_point: Point = graph.nodes[start]["coord"]
-            endpoint: Point = graph.nodes[target]["coord"]
-            point_path: list[Point] = [graph.nodes[node]["coord"] for node in path]
-            routes.append(
-                Route(
-                    compute_total_distance(graph, path),
-                    start_point,
-                    endpoint,
-                    point_path,
-                )
-            )
         # it could be that we cannot reach a certain monument
-        except nx.NetworkXNoPath:
+        if target not in distances:
             print(
-                f"There's no path between your starting point and {graph.nodes[target]['monuments'][0].name}"
+                f"There's no path between your starting point and {assignment[target][0].name}"
             )
+            continue
+        path = reconstruct_path(predecessors, target)
+        endpoint: Point = graph.nodes[target]["coord"]
+        point_path: list[Point] = [graph.nodes[node]["coord"] for node in path]
+        routes.append(Route(distances[target], start_point, endpoint, point_path))
     return routes
 
 
@@ -83,15 +127,88 @@ def find_routes(graph: nx.Graph, start: Point, endpoints: Monuments) -> Routes:
     """
     Find the shortest routes between the starting point "start" and all the endpoints.
     """
-    assign_monuments(graph, endpoints)
-    return find_shortest_routes(graph, search_for_closest_node(graph, start))
+    # a single index of the nodes serves to place both the monuments and the starting point
+    with stage("assign_monuments", monuments=len(endpoints)):
+        index = build_node_index(graph)
+        assignment = assign_monuments(graph, endpoints, index)
+    with stage("routing", targets=len(assignment)):
+        return find_shortest_routes(graph, closest_nodes(index, [start])[0], assignment)
 
 
-def export_routes_PNG(routes: Routes, filename: str) -> None:
+def batch_shortest_paths(
+    csr: CSRGraph, sources: list[int], workers: int
+) -> tuple[ndarray, ndarray]:
     """
-    Export the graph to a PNG file using staticmap.
+    Returns the same as shortest_paths(csr, sources), splitting the sources among 'workers' processes.
     """
-    map = StaticMap(800, 600)
+    if workers <= 1 or len(sources) <= 1:
+        return shortest_paths(csr, sources)
+    chunks = [
+        chunk.tolist() for chunk in np.array_split(sources, min(workers, len(sources)))
+    ]
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        results = list(executor.map(shortest_paths, repeat(csr), chunks))
+    return (
+        np.concatenate([distances for distances, _ in results]),
+        np.concatenate([predecessors for _, predecessors in results]),
+    )
+
+
+def find_routes_batch(
+    graph: nx.Graph, starts: list[Point], endpoints: Monuments, workers: int = 1
+) -> list[Routes]:
+    """
+    Find the shortest routes between each one of the starting points "starts" and all the endpoints, and return
+    the routes of each starting point in the same order. The monuments are assigned and the nodes are indexed only
+    once for all the starting points, and the shortest path searches run on 'workers' processes.
+    The graph is not modified.
+    """
+    index = build_node_index(graph)
+    assignment = assign_monuments(graph, endpoints, index)
+    csr = from_networkx(graph)
+    nodes = csr.nodes.tolist()
+    position = {node: i for i, node in enumerate(nodes)}
+    start_nodes = closest_nodes(index, starts)
+    # starting points with the same closest node share their search
+    sources = sorted({position[node] for node in start_nodes})
+    distances, predecessors = batch_shortest_paths(csr, sources, workers)
+    row = {source: i for i, source in enumerate(sources)}
+    targets = [node for node in nodes if node in assignment]
+
+    all_routes: list[Routes] = []
+    for start_node in start_nodes:
+        i = row[position[start_node]]
+        start_point: Point = graph.nodes[start_node]["coord"]
+        routes = []
+        for target in targets:
+            # it could be that we cannot reach a certain monument
+            if np.isinf(distances[i, position[target]]):
+                print(
+                    f"There's no path between ({start_point.lat}, {start_point.lon}) and {assignment[target][0].name}"
+                )
+                continue
+            path = [nodes[j] for j in path_to(predecessors[i], position[target])]
+            routes.append(
+                Route(
+                    float(distances[i, position[target]]),
+                    start_point,
+                    graph.nodes[target]["coord"],
+                    [graph.nodes[node]["coord"] for node in path],
+                )
+            )
+        all_routes.append(routes)
+    return all_routes
+
+
+@instrumented
+def export_routes_PNG(
+    routes: Routes, filename: Optional[str], display: bool = True
+) -> Optional[bytes]:
+    """
+    Export the routes to a PNG file "filename" using staticmap, and show it if 'display' is True.
+    If filename is None the PNG is returned as bytes instead (see save_map).
+    """
+    map = new_static_map()
     # mark the starting point in red only once (all routes start there)
     start_marker = CircleMarker((routes[0].start.lon, routes[0].start.lat), "red", 8)
     for route in routes:
@@ -108,30 +225,27 @@ def export_routes_PNG(routes: Routes, filename: str) -> None:
             )
             map.add_line(line)
     # save and display the map
-    map.render().save(filename)
-    display_map(filename)
+    return save_map(map.render(), filename, display)
 
 
+@instrumented
 def export_routes_KML(routes: Routes, filename: str) -> None:
     """
-    Export the routes to a KML file named "filename".
+    Export the routes to a KML file named "filename" (compressed as KMZ if its extension is .kmz).
+    The routes are written one by one as they are added.
     """
-    kml = simplekml.Kml()
-    # mark starting point only once (all routes start there)
-    start_point = kml.newpoint(
-        name="Start Point", coords=[(routes[0].start.lon, routes[0].start.lat)]
-    )
-    for route in routes:
-        # mark endpoint of each route
-        end_point = kml.newpoint(
-            name="End point", coords=[(route.end.lon, route.end.lat)]
-        )
-        # add routes
-        linestring = kml.newlinestring()
-        linestring.coords = [(point.lon, point.lat) for point in route.path]
-        linestring.style.linestyle.color = simplekml.Color.rgb(254, 130, 140)
-        linestring.style.linestyle.width = 3
-        linestring.name = f"Route from ({route.start.lat}, {route.start.lon}) to ({route.end.lat}, {route.end.lon})"
-        linestring.description = f"Total Distance: {route.total_dist} km"
-    # save the map
-    kml.save(filename)
+    with KMLWriter(filename) as kml:
+        # all the routes share the same style
+        kml.add_style("route", kml_color(254, 130, 140), 3)
+        # mark starting point only once (all routes start there)
+        kml.add_point("Start Point", (routes[0].start.lon, routes[0].start.lat))
+        for route in routes:
+            # mark endpoint of each route
+            kml.add_point("End point", (route.end.lon, route.end.lat))
+            # add routes
+            kml.add_linestring(
+                f"Route from ({route.start.lat}, {route.start.lon}) to ({route.end.lat}, {route.end.lon})",
+                [(point.lon, point.lat) for point in route.path],
+                "route",
+                f"Total Distance: {route.total_dist} km",
+            )
@@ -1,13 +1,28 @@
 import os
-import gpxpy
+import json
+import math
+import time
+import threading
 import requests
 import staticmap
-from typing import TypeAlias
-from datetime import datetime
+import numpy as np
+from numpy import ndarray
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import repeat
+from types import TracebackType
+from typing import Iterator, TextIO, TypeAlias
 from typing import Optional
-from geographical import Point, Zone, distance_between_points
+from urllib.parse import urlparse
+from datetime import datetime, timezone
+from io import BytesIO
+from xml.etree import ElementTree
+from geographical import Point, Zone, distances_between_points, in_zone_mask
+from atomicfile import atomic_write
 from dataclasses import dataclass
-from viewer import display_map
+from viewer import save_map
+from instrumentation import instrumented, stage
+from rendering import merge_into_polylines, new_static_map
 
 
 @dataclass
@@ -16,140 +31,699 @@ class Segment:
     end: Point
 
 
-Segments: TypeAlias = list[Segment]
+@dataclass(eq=False)
+class SegmentArray:
+    """
+    Segments stored as a float64 array with one row per segment in the format: lat1, lon1, lat2, lon2.
+    The array can be a memory map of a segment cache file, so it is never modified.
+    """
+
+    coords: ndarray
+
+    def __len__(self) -> int:
+        return len(self.coords)
+
+    def __getitem__(self, i: int) -> Segment:
+        lat1, lon1, lat2, lon2 = self.coords[i]
+        return Segment(Point(float(lat1), float(lon1)), Point(float(lat2), float(lon2)))
+
+    def __iter__(self) -> Iterator[Segment]:
+        for i in range(len(self.coords)):
+            yield self[i]
 
-MAX_TIME = 100  # maximum time difference acceptable between two points read like xx : xx (min, sec)
+    @property
+    def endpoints(self) -> ndarray:
+        """
+        Returns a (2 * #segments, 2) view of the coordinates with the start and end points of every segment,
+        without copying them: the points in positions 0-1 are a segment, as are those in 2-3, 4-5, etc.
+        """
+        return self.coords.reshape(-1, 2)
+
+
+Segments: TypeAlias = SegmentArray
+
+MAX_TIME = 60  # maximum time difference in seconds acceptable between two points
+SECONDS_PER_DAY = 24 * 60 * 60
 MAX_DIST = 0.1  # maximum distance in Km acceptable between two points
 
+TRACKPOINTS_URL = "https://api.openstreetmap.org/api/0.6/trackpoints"
+PAGES_IN_FLIGHT = 4  # number of trackpoint pages that are downloaded at the same time
+REQUEST_TIMEOUT = 60  # seconds to wait for a page before giving up
+MAX_BOX_AREA = 0.25  # largest area in square degrees the trackpoints API accepts in a single request
+BOX_MARGIN = 0.001  # degrees (~100m) sub-boxes overlap by, so segments crossing their borders are not lost
+HOST_CONNECTIONS = 4  # maximum number of requests sent to the same host at the same time
+REQUESTS_PER_SECOND = 4  # maximum number of requests started every second on the same host
+
+
+def valid_segments_mask(lats: ndarray, lons: ndarray, times: ndarray) -> ndarray:
+    """
+    Given the coordinates and times (in seconds since the epoch) of the points of a track in chronological order,
+    returns a boolean array whose i-th value is True iff the segment between points i and i+1 could realistically
+    happen, geographically and chronologically speaking (the points are not too far apart, they were recorded
+    on the same day and the time difference between them is reasonable)
+    """
+    starts = np.column_stack((lats[:-1], lons[:-1]))
+    ends = np.column_stack((lats[1:], lons[1:]))
+    time_differences = np.diff(times)
+    same_day = (times[:-1] // SECONDS_PER_DAY) == (times[1:] // SECONDS_PER_DAY)
+    return (
+        (time_differences >= 0)
+        & (time_differences <= MAX_TIME)
+        & same_day
+        & (distances_between_points(starts, ends) <= MAX_DIST)
+    )
+
+
+def trackpoints_url(zone: Zone, page: int, base_url: str = TRACKPOINTS_URL) -> str:
+    """
+    Returns the url of the page number 'page' of the OpenStreetMaps trackpoints in the zone
+    """
+    p1, p2 = zone.bottom_left, zone.top_right
+    # to insert the zone into the url we need it to be in string format
+    zone_string = "{},{},{},{}".format(p1.lon, p1.lat, p2.lon, p2.lat)
+    return f"{base_url}?bbox={zone_string}&page={page}"
+
+
+def new_session(pages_in_flight: int) -> requests.Session:
+    """
+    Returns an http session whose connection pool is big enough to keep 'pages_in_flight' requests open at once
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pages_in_flight
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
 
-def format_date_and_time(
-    time: Optional[datetime],
-) -> Optional[tuple[int, int]]:  # Optional because time can be None when downloading
+class HostLimiter:
     """
-    Converts date and time from "datetime" object into a tuple which contains the date and
-    time as integers in the format (YYMMDD, HHMMSS)
+    Limits the requests sent to a host: at most 'connections' at the same time, started at most
+    'requests_per_second' times per second. Every request is sent inside a with block:
+        with limiter:
+            session.get(url)
     """
-    if time is not None:
-        return (int(time.strftime("%Y%m%d")), int(time.strftime("%H%M%S")))
-    return None
+
+    def __init__(self, connections: int, requests_per_second: float) -> None:
+        self.slots = threading.BoundedSemaphore(connections)
+        self.interval = 1 / requests_per_second
+        self.lock = threading.Lock()
+        self.next_start = 0.0  # time.monotonic() before which no other request can start
+
+    def __enter__(self) -> "HostLimiter":
+        self.slots.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + self.interval
+        time.sleep(start - now)
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.slots.release()
 
 
-def is_segment_valid(
-    p1: Point, p2: Point, p1_time: datetime, p2_time: datetime
-) -> bool:
+host_limiters: dict[str, HostLimiter] = {}  # host: limiter shared by every download from that host
+host_limiters_lock = threading.Lock()
+
+
+def host_limiter(url: str) -> HostLimiter:
     """
-    Returns True iff the segment (p1, p2) could realistically happen between times p1_time and p2_time,
-    geographically and chronologically speaking (p1 and p2 are not too far apart and the time difference is reasonable)
+    Returns the limiter of the host of 'url', which is shared by all the threads that download from it
     """
-    time1, time2 = format_date_and_time(p1_time), format_date_and_time(p2_time)
-    if time1 and time2:
-        if time1[1] > time2[1]:
-            return False
-        elif (time2[1] - time1[1]) > MAX_TIME:
-            return False
-        elif time1[0] != time2[0]:
-            return False
-        elif distance_between_points(p1, p2) > MAX_DIST:
-            return False
-        return True
-    return False
+    host = urlparse(url).netloc
+    with host_limiters_lock:
+        if host not in host_limiters:
+            host_limiters[host] = HostLimiter(HOST_CONNECTIONS, REQUESTS_PER_SECOND)
+        return host_limiters[host]
+
 
+def fetch_page(session: requests.Session, url: str) -> bytes:
+    """
+    Downloads the page with url 'url' using the session and returns its raw content.
+    Requests to the same host are limited (see HostLimiter), however many downloads are running.
+    """
+    with host_limiter(url):
+        response = session.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()  # Raise an exception for bad status codes
+    return response.content
 
-def download_segments(zone: Zone, filename: str) -> None:
+
+def local_name(tag: str) -> str:
+    """
+    Returns the name of an XML tag without its namespace: "{http://www.topografix.com/GPX/1/0}trkpt" -> "trkpt"
+    """
+    return tag.rpartition("}")[2]
+
+
+def parse_time(text: Optional[str]) -> Optional[float]:
+    """
+    Converts a GPX time like "2012-05-05T10:20:30Z" into seconds since the epoch. Times without a timezone are UTC.
+    """
+    if not text:
+        return None
+    time = datetime.fromisoformat(text.strip())
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return time.timestamp()
+
+
+def iter_track_segments(
+    gpx_content: bytes,
+) -> Iterator[tuple[list[float], list[float], list[Optional[float]]]]:
+    """
+    Parses the GPX page 'gpx_content' incrementally and yields the latitudes, longitudes and times of the
+    points of each track segment, one track segment at a time. Points are discarded as soon as they are read,
+    so no tree of the whole page is ever built.
+    """
+    lats: list[float] = []
+    lons: list[float] = []
+    times: list[Optional[float]] = []
+    root = None
+    for event, element in ElementTree.iterparse(
+        BytesIO(gpx_content), events=("start", "end")
+    ):
+        if root is None:
+            root = element  # the first element to start is the <gpx> root
+        if event == "start":
+            continue
+        name = local_name(element.tag)
+        if name == "trkpt":
+            time = next(
+                (child.text for child in element if local_name(child.tag) == "time"),
+                None,
+            )
+            lats.append(float(element.attrib["lat"]))
+            lons.append(float(element.attrib["lon"]))
+            times.append(parse_time(time))
+            element.clear()
+        elif name == "trkseg":
+            yield lats, lons, times
+            lats, lons, times = [], [], []
+        elif name == "trk":
+            # forget the tracks that have already been read
+            root.clear()
+
+
+def write_page_segments(gpx_content: bytes, file: TextIO) -> bool:
+    """
+    Writes all valid segments of the GPX page 'gpx_content' to the file in chronological order.
+    Returns False iff the page has no tracks (we have gone past the last page)
+    """
+    has_tracks = False
+    for point_lats, point_lons, point_times in iter_track_segments(gpx_content):
+        has_tracks = True
+        if len(point_times) > 1 and all(time is not None for time in point_times):
+            # save two-point segments in chronological order in the file if they are valid
+            times = np.array(point_times, dtype=np.float64)
+            order = np.argsort(times, kind="stable")
+            lats = np.array(point_lats)[order]
+            lons = np.array(point_lons)[order]
+            valid = valid_segments_mask(lats, lons, times[order])
+            for i in np.flatnonzero(valid):
+                file.write(f"{lats[i]}, {lons[i]} - {lats[i + 1]}, {lons[i + 1]}\n")
+    return has_tracks
+
+
+@dataclass
+class DownloadManifest:
+    zone: Zone
+    next_page: int  # first page that has not been written to the data file yet
+    offset: int  # size in bytes of the data file after writing page 'next_page' - 1
+    complete: bool  # True iff the last (empty) page has been reached
+
+
+def manifest_filename(filename: str) -> str:
+    """
+    Returns the name of the file where the download progress of the data file 'filename' is recorded
+    """
+    return filename + ".manifest"
+
+
+def read_manifest(filename: str) -> Optional[DownloadManifest]:
+    """
+    Returns the download manifest of the data file 'filename', or None if it has none
+    """
+    try:
+        with open(manifest_filename(filename), "r") as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return None
+    bl_lat, bl_lon, tr_lat, tr_lon = data["zone"]
+    return DownloadManifest(
+        Zone(Point(bl_lat, bl_lon), Point(tr_lat, tr_lon)),
+        data["next_page"],
+        data["offset"],
+        data["complete"],
+    )
+
+
+def write_manifest(filename: str, manifest: DownloadManifest) -> None:
+    """
+    Saves the download manifest of the data file 'filename' (see atomic_write)
+    """
+    p1, p2 = manifest.zone.bottom_left, manifest.zone.top_right
+    data = {
+        "zone": [p1.lat, p1.lon, p2.lat, p2.lon],
+        "next_page": manifest.next_page,
+        "offset": manifest.offset,
+        "complete": manifest.complete,
+    }
+    with atomic_write(manifest_filename(filename)) as file:
+        json.dump(data, file)
+
+
+def is_download_complete(filename: str) -> bool:
+    """
+    Returns True iff the data file 'filename' exists and its download was finished.
+    Data files without a manifest were downloaded before manifests existed and are considered complete.
+    """
+    if not os.path.exists(filename):
+        return False
+    manifest = read_manifest(filename)
+    return manifest is None or manifest.complete
+
+
+def start_or_resume_download(zone: Zone, filename: str) -> DownloadManifest:
+    """
+    Returns the manifest a download of the zone into 'filename' has to continue from. If an interrupted
+    download of the same zone exists, the data file is cut back to its last complete page so that it
+    can be resumed. Otherwise the download starts again from the first page.
+    """
+    manifest = read_manifest(filename)
+    if (
+        manifest is not None
+        and manifest.zone == zone
+        and os.path.exists(filename)
+        and os.path.getsize(filename) >= manifest.offset
+    ):
+        # remove whatever was written of a page that was not finished
+        os.truncate(filename, manifest.offset)
+        manifest.complete = False
+        return manifest
+    manifest = DownloadManifest(zone, 0, 0, False)
+    open(filename, "w").close()
+    write_manifest(filename, manifest)
+    return manifest
+
+
+def download_segments(
+    zone: Zone,
+    filename: str,
+    pages_in_flight: int = PAGES_IN_FLIGHT,
+    base_url: str = TRACKPOINTS_URL,
+) -> None:
+    """
+    Download all segments in the zone and save them to the file 'filename' in the following format:
+    lat1, lon1 - lat2, lon2
+    'base_url' can point to any server that mimics the OpenStreetMaps trackpoints API. Zones bigger than
+    MAX_BOX_AREA are split into sub-boxes that are downloaded in parallel (see download_split_zone), the rest
+    are downloaded with a single request per page (see download_box).
+    """
+    if zone_area(zone) > MAX_BOX_AREA:
+        download_split_zone(zone, filename, pages_in_flight, base_url)
+    else:
+        download_box(zone, filename, pages_in_flight, base_url)
+
+
+def download_box(
+    zone: Zone,
+    filename: str,
+    pages_in_flight: int = PAGES_IN_FLIGHT,
+    base_url: str = TRACKPOINTS_URL,
+) -> None:
     """
     Download all segments in the zone and save them to the file 'filename' in chronological
     order in the following format:  lat1, lon1 - lat2, lon2
+    Up to 'pages_in_flight' pages are downloaded at the same time, but they are written to the file
+    in page order. 'base_url' can point to any server that mimics the OpenStreetMaps trackpoints API.
+    The progress is recorded in a manifest next to the file after every page, so an interrupted
+    download resumes from the first page that was not written. If a page cannot be downloaded, the
+    requests exception is raised once the pages before it are saved.
+    Pre: the zone is not bigger than MAX_BOX_AREA
     """
-    p1, p2 = zone.bottom_left, zone.top_right
-    # to insert the zone into the url we need it to be in string format
-    zone_string = "{},{}, {},{}".format(p1.lon, p1.lat, p2.lon, p2.lat)
-
-    page = 0
-    with open(filename, "w") as file:
-        while True:
-            try:
-                # get the OpenStreetMaps content for the zone
-                url = f"https://api.openstreetmap.org/api/0.6/trackpoints?bbox={zone_string}&page={page}"
-                response = requests.get(url)
-                response.raise_for_status()  # Raise an exception for bad status codes
-                gpx_content = response.content.decode("utf-8")
-                gpx = gpxpy.parse(gpx_content)
-
-                if len(gpx.tracks) == 0:
+    manifest = start_or_resume_download(zone, filename)
+    session = new_session(pages_in_flight)
+    executor = ThreadPoolExecutor(max_workers=pages_in_flight)
+    # pages that have been requested but not written yet, in page order
+    in_flight: deque[Future[bytes]] = deque()
+    next_page = manifest.next_page
+    try:
+        with open(filename, "a") as file:
+            while True:
+                # keep the pipeline full: always have 'pages_in_flight' pages requested
+                while len(in_flight) < pages_in_flight:
+                    url = trackpoints_url(zone, next_page, base_url)
+                    in_flight.append(executor.submit(fetch_page, session, url))
+                    next_page += 1
+                # the oldest request is the next page that has to be written
+                try:
+                    gpx_content = in_flight.popleft().result()
+                except requests.RequestException as e:
+                    print(f"An error occurred while fetching data: {e}")
+                    print(
+                        f"The download stopped at page {manifest.next_page}, it will resume from there next time."
+                    )
+                    # the pages written so far are kept, but they must not be used as if they were all the data
+                    raise
+                # the first empty page marks the end of the data
+                manifest.complete = not write_page_segments(gpx_content, file)
+                if not manifest.complete:
+                    # the page must be on disk before the manifest says so
+                    file.flush()
+                    os.fsync(file.fileno())
+                    manifest.next_page += 1
+                    manifest.offset = file.tell()
+                write_manifest(filename, manifest)
+                if manifest.complete:
                     break
+    finally:
+        # pages requested after the last one are not needed anymore
+        for future in in_flight:
+            future.cancel()
+        executor.shutdown(wait=True)
+        session.close()
 
-                for track in gpx.tracks:
-                    for segment in track.segments:
-                        if all(point.time is not None for point in segment.points):
-                            # save two-point segments in chronological order in the file if they are valid
-                            segment.points.sort(key=lambda p: p.time)
-                            for i in range(len(segment.points) - 1):
-                                p1, p2 = segment.points[i], segment.points[i + 1]
-                                point1 = Point(float(p1.latitude), float(p1.longitude))
-                                point2 = Point(float(p2.latitude), float(p2.longitude))
-                                if is_segment_valid(point1, point2, p1.time, p2.time):
-                                    file.write(
-                                        f"{p1.latitude}, {p1.longitude} - {p2.latitude}, {p2.longitude}\n"
-                                    )
-                page += 1
-            except requests.RequestException as e:
-                print(f"An error occurred while fetching data: {e}")
-                break  # Exit the loop if there's an error
 
+def cache_filename(filename: str) -> str:
+    """
+    Returns the name of the binary cache of the segment data file 'filename'
+    """
+    return os.path.splitext(filename)[0] + ".npy"
 
-def load_segments(filename: str) -> Segments:
+
+def cache_source_filename(filename: str) -> str:
+    """
+    Returns the name of the file that records which version of the data file 'filename' its binary cache has
+    """
+    return cache_filename(filename) + ".source"
+
+
+def source_signature(filename: str) -> list[int]:
+    """
+    Returns the size and modification time in nanoseconds of the data file 'filename', which change whenever
+    the file does
+    """
+    status = os.stat(filename)
+    return [status.st_size, status.st_mtime_ns]
+
+
+def is_cache_fresh(filename: str) -> bool:
+    """
+    Returns True iff the binary cache of 'filename' exists and was made from the current version of the data file.
+    Comparing the modification times of both files is not enough: a data file changed right after its cache was
+    written can have the same modification time as the cache.
+    """
+    try:
+        with open(cache_source_filename(filename), "r") as file:
+            signature = json.load(file)
+    except (OSError, ValueError):
+        return False
+    return os.path.exists(cache_filename(filename)) and signature == source_signature(
+        filename
+    )
+
+
+def zone_area(zone: Zone) -> float:
+    """
+    Returns the area of the zone in square degrees, which is how the trackpoints API measures it
+    """
+    p1, p2 = zone.bottom_left, zone.top_right
+    return (p2.lat - p1.lat) * (p2.lon - p1.lon)
+
+
+def split_zone(
+    zone: Zone, max_area: float = MAX_BOX_AREA, margin: float = BOX_MARGIN
+) -> list[Zone]:
+    """
+    Splits the zone into a grid of sub-boxes of at most 'max_area' square degrees, row by row.
+    Neighbouring sub-boxes overlap by 'margin' degrees on each side of their common border.
+    """
+    # the margin is part of the sub-box too
+    side = math.sqrt(max_area) - 2 * margin
+    p1, p2 = zone.bottom_left, zone.top_right
+    lats = np.linspace(p1.lat, p2.lat, max(1, math.ceil((p2.lat - p1.lat) / side)) + 1)
+    lons = np.linspace(p1.lon, p2.lon, max(1, math.ceil((p2.lon - p1.lon) / side)) + 1)
+    return [
+        Zone(
+            Point(max(p1.lat, float(lat1) - margin), max(p1.lon, float(lon1) - margin)),
+            Point(min(p2.lat, float(lat2) + margin), min(p2.lon, float(lon2) + margin)),
+        )
+        for lat1, lat2 in zip(lats[:-1], lats[1:])
+        for lon1, lon2 in zip(lons[:-1], lons[1:])
+    ]
+
+
+def parts_dirname(filename: str) -> str:
+    """
+    Returns the name of the directory where the sub-boxes of the data file 'filename' are downloaded
+    """
+    return filename + ".parts"
+
+
+def read_merged_offsets(filename: str, parts: int) -> list[int]:
+    """
+    Returns how many bytes of each one of the 'parts' sub-box files of 'filename' are already merged into it
+    """
+    try:
+        with open(os.path.join(parts_dirname(filename), "merged.json"), "r") as file:
+            offsets = json.load(file)
+    except (OSError, ValueError):
+        return [0] * parts
+    return offsets if len(offsets) == parts else [0] * parts
+
+
+def write_merged_offsets(filename: str, offsets: list[int]) -> None:
+    """
+    Saves how many bytes of each sub-box file of 'filename' are merged into it (see atomic_write)
+    """
+    with atomic_write(os.path.join(parts_dirname(filename), "merged.json")) as file:
+        json.dump(offsets, file)
+
+
+def merge_parts(zone: Zone, filename: str, part_files: list[str]) -> None:
+    """
+    Appends to 'filename' the segments of the sub-box files 'part_files' that were downloaded since the last
+    merge, leaving out the segments outside the zone and the ones already in the file (segments near the border
+    of two sub-boxes are downloaded twice). The file only grows, so it can be updated like any other download.
+    """
+    manifest = read_manifest(filename)
+    if (
+        manifest is not None
+        and manifest.zone == zone
+        and os.path.exists(filename)
+        and os.path.getsize(filename) >= manifest.offset
+    ):
+        # remove whatever was written of a merge that was not finished
+        os.truncate(filename, manifest.offset)
+        offsets = read_merged_offsets(filename, len(part_files))
+    else:
+        manifest = DownloadManifest(zone, 0, 0, False)
+        open(filename, "w").close()
+        offsets = [0] * len(part_files)
+
+    part_manifests = [read_manifest(part_file) for part_file in part_files]
+    new_parts: list[ndarray] = []
+    for k, (part_file, part_manifest) in enumerate(zip(part_files, part_manifests)):
+        # only the pages that were completely written are merged
+        end = part_manifest.offset if part_manifest is not None else 0
+        if end < offsets[k]:
+            # the sub-box was downloaded again from scratch, its repeated segments are dropped below
+            offsets[k] = 0
+        if end > offsets[k]:
+            with open(part_file, "rb") as file:
+                file.seek(offsets[k])
+                text = file.read(end - offsets[k]).decode("utf-8")
+            new_parts.append(parse_segments_text(text))
+        offsets[k] = end
+    new_coords = np.concatenate(new_parts) if new_parts else np.empty((0, 4))
+    new_coords = unseen_segments(
+        load_segments(filename).coords, new_coords[zone_mask(new_coords, zone)]
+    )
+
+    with open(filename, "a") as file:
+        for lat1, lon1, lat2, lon2 in new_coords.tolist():
+            file.write(f"{lat1}, {lon1} - {lat2}, {lon2}\n")
+        file.flush()
+        os.fsync(file.fileno())
+        manifest.offset = file.tell()
+    manifest.complete = all(
+        part_manifest is not None and part_manifest.complete
+        for part_manifest in part_manifests
+    )
+    # if the offsets are not saved, the same segments are merged again next time and dropped as repeated
+    write_manifest(filename, manifest)
+    write_merged_offsets(filename, offsets)
+
+
+def download_split_zone(
+    zone: Zone,
+    filename: str,
+    pages_in_flight: int = PAGES_IN_FLIGHT,
+    base_url: str = TRACKPOINTS_URL,
+) -> None:
+    """
+    Download all segments in a zone too big for a single request and save them to the file 'filename'.
+    The zone is split into sub-boxes (see split_zone) that are downloaded in parallel, each one into its own file
+    that resumes like any other download, and then their segments are merged into 'filename' (see merge_parts).
+    Segments of different sub-boxes are not in chronological order.
+    """
+    part_files = [
+        os.path.join(parts_dirname(filename), f"{k}.txt")
+        for k in range(len(split_zone(zone)))
+    ]
+    os.makedirs(parts_dirname(filename), exist_ok=True)
+    # the requests of all the sub-boxes are limited together by the limiter of the host
+    with ThreadPoolExecutor(max_workers=HOST_CONNECTIONS) as executor:
+        list(
+            executor.map(
+                download_box,
+                split_zone(zone),
+                part_files,
+                repeat(pages_in_flight),
+                repeat(base_url),
+            )
+        )
+    merge_parts(zone, filename, part_files)
+
+
+def zone_mask(coords: ndarray, zone: Zone) -> ndarray:
+    """
+    Returns which rows of the (#segments, 4) array of segments 'coords' have both endpoints inside the zone
+    """
+    return in_zone_mask(zone, coords[:, [0, 2]], coords[:, [1, 3]]).all(axis=1)
+
+
+def parse_segments_text(text: str) -> ndarray:
     """
-    Loads segments from the file 'filename' and returns a list of segments.
+    Parses the lines of segment data in 'text' and returns their segments as a (#segments, 4) array.
+    Pre: each line has the following format: lat1, lon1 - lat2, lon2
+    """
+    # turning separators into spaces lets numpy read all the numbers in one go
+    text = text.replace(" - ", " ").replace(",", " ")
+    if not text.strip():
+        return np.empty((0, 4), dtype=np.float64)
+    return np.fromstring(text, dtype=np.float64, sep=" ").reshape(-1, 4)
+
+
+def parse_segments(filename: str) -> ndarray:
+    """
+    Parses the segment data file 'filename' and returns its segments as a (#segments, 4) array.
     Pre: segment data file should have the following format in each line: lat1, lon1 - lat2, lon2
     """
-    segments: Segments = []
     with open(filename, "r") as file:
-        for line in file:
-            # every line is in the format: lat1, lon1 - lat2, lon2
-            points_data = line.strip().split(" - ")
-            point1_data = points_data[0].split(", ")
-            point2_data = points_data[1].split(", ")
-
-            point1 = Point(
-                float(point1_data[0]),
-                float(point1_data[1]),
-            )
-            point2 = Point(
-                float(point2_data[0]),
-                float(point2_data[1]),
-            )
-            segments.append(Segment(point1, point2))
-    return segments
+        return parse_segments_text(file.read())
+
+
+def drop_duplicate_segments(coords: ndarray) -> ndarray:
+    """
+    Returns the (#segments, 4) array of segments 'coords' without repeated segments. The first time each
+    segment appears is kept, and segments stay in their original order.
+    """
+    if len(coords) == 0:
+        return coords
+    _, first = np.unique(coords, axis=0, return_index=True)
+    return coords[np.sort(first)]
+
+
+def unseen_segments(seen: ndarray, coords: ndarray) -> ndarray:
+    """
+    Returns the segments of 'coords' that are not in 'seen' (both are (#segments, 4) arrays of segments),
+    each one only once and in their original order
+    """
+    combined = np.concatenate((seen, coords))
+    _, first = np.unique(combined, axis=0, return_index=True)
+    return combined[np.sort(first[first >= len(seen)])]
+
+
+def write_cache(filename: str, coords: ndarray, signature: list[int]) -> None:
+    """
+    Saves the segment array 'coords' as the binary cache of the data file 'filename', parsed from the version
+    of the file with signature 'signature' (see source_signature and atomic_write)
+    """
+    with atomic_write(cache_filename(filename), "wb") as file:
+        np.save(file, coords)
+    # the signature is written last, so a cache is never taken for a version of the file it was not made from
+    with atomic_write(cache_source_filename(filename)) as file:
+        json.dump(signature, file)
+
+
+def load_segments(filename: str) -> Segments:
+    """
+    Loads segments from the file 'filename' and returns them as a segment array.
+    The text file is only parsed the first time (or after it changes): its segments are saved to a binary cache
+    next to it, and later loads memory-map that cache instead.
+    Pre: segment data file should have the following format in each line: lat1, lon1 - lat2, lon2
+    """
+    if is_cache_fresh(filename):
+        return SegmentArray(np.load(cache_filename(filename), mmap_mode="r"))
+    # taken before parsing, so a file that changes while it is parsed is parsed again next time
+    signature = source_signature(filename)
+    coords = parse_segments(filename)
+    write_cache(filename, coords, signature)
+    return SegmentArray(coords)
 
 
 def get_segments(zone: Zone, filename: str) -> Segments:
     """
-    Get all cleaned data of the segments in the box. If filename exists, load segments
-    from the file. Otherwise, download segments in the box and save them to the file.
+    Get all cleaned data of the segments in the box. If filename holds a complete download, load segments
+    from the file. Otherwise, download (or finish downloading) segments in the box and save them to the file.
     """
-    if not os.path.exists(filename):
-        download_segments(zone, filename)
-    return load_segments(filename)
+    if not is_download_complete(filename):
+        with stage("download", file=filename):
+            download_segments(zone, filename)
+    with stage("load", file=filename):
+        return load_segments(filename)
 
 
-def show_segments(segments: Segments, filename: str) -> None:
+def download_new_segments(
+    zone: Zone,
+    filename: str,
+    pages_in_flight: int = PAGES_IN_FLIGHT,
+    base_url: str = TRACKPOINTS_URL,
+) -> Segments:
     """
-    Show all segments in a PNG file with name filename using staticmap.
+    Downloads only the pages of the zone that were published after 'filename' was last downloaded, appends their
+    segments to the file and returns the new segments. Trackpoints are served oldest first, so new data always
+    comes after the last page that was downloaded. If the file has no download of the same zone, the zone is
+    downloaded from the first page and every segment is new.
     """
-    static_map = staticmap.StaticMap(800, 600)
-    for segment in segments:
-        line = staticmap.Line(
-            [
-                (segment.start.lon, segment.start.lat),
-                (segment.end.lon, segment.end.lat),
-            ],
-            color="black",
-            width=1,
-        )
-        static_map.add_line(line)
-    static_map.render().save(filename, format="png")
+    manifest = read_manifest(filename)
+    previous_offset = 0
+    if (
+        manifest is not None
+        and manifest.zone == zone
+        and os.path.exists(filename)
+        and os.path.getsize(filename) >= manifest.offset
+    ):
+        previous_offset = manifest.offset
+    # a complete download is resumed from its first empty page, which is where new data will appear
+    download_segments(zone, filename, pages_in_flight, base_url)
+    with open(filename, "rb") as file:
+        file.seek(previous_offset)
+        return SegmentArray(parse_segments_text(file.read().decode("utf-8")))
+
+
+@instrumented
+def show_segments(
+    segments: Segments, filename: Optional[str], display: bool = True
+) -> Optional[bytes]:
+    """
+    Show all segments in a PNG file with name filename using staticmap (only saved if 'display' is False).
+    If filename is None the PNG is returned as bytes instead (see save_map).
+    Consecutive segments that form a track are drawn as a single line.
+    """
+    static_map = new_static_map()
+    for polyline in merge_into_polylines(segments.coords):
+        static_map.add_line(staticmap.Line(polyline, color="black", width=1))
     # show the map automatically
-    display_map(filename)
+    return save_map(static_map.render(), filename, display)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+import json
+import math
+import argparse
+import threading
+import networkx as nx
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+from geographical import Point, Zone
+from graphmaker import DEFAULT_BACKEND
+from graphcache import get_cached_graph
+from monuments import load_monuments
+from routes import (
+    MonumentAssignment,
+    NodeIndex,
+    Routes,
+    assign_monuments,
+    build_node_index,
+    closest_nodes,
+    find_shortest_routes,
+)
+from segments import is_download_complete, load_segments
+
+
+MAX_ZONES = 8  # number of zones whose graphs are kept in memory at the same time
+
+
+@dataclass
+class ZoneConfig:
+    zone: Zone
+    segment_data: str  # file with the (already downloaded) segments of the zone
+    clusters: Optional[int] = None
+    epsilon: Optional[float] = None
+    backend: str = DEFAULT_BACKEND
+
+
+@dataclass
+class WarmZone:
+    graph: nx.Graph  # graph of the zone, never modified after it is built
+    index: NodeIndex  # index of the nodes of the graph to place starting points
+    assignment: MonumentAssignment  # monuments of the zone assigned to the nodes of the graph
+
+
+@dataclass
+class ServiceState:
+    zones: dict[str, ZoneConfig]
+    monument_data: str
+    max_zones: int = MAX_ZONES
+    # the most recently used zones are at the end
+    warm: OrderedDict[str, WarmZone] = field(default_factory=OrderedDict)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    # a zone is only built by one request at a time, the others wait for it
+    zone_locks: dict[str, threading.Lock] = field(default_factory=dict)
+
+
+def read_config(filename: str) -> tuple[dict[str, ZoneConfig], str]:
+    """
+    Reads the zones served and the monument data file from the JSON file "filename", which looks like:
+    {"monument_data": "monument_data.txt",
+     "zones": {"ebre": {"zone": [40.53, 0.57, 40.79, 0.90], "segment_data": "data_EBRE.txt", "clusters": 100}}}
+    where zones are given as [bottom left lat, bottom left lon, top right lat, top right lon].
+    "clusters", "epsilon" and "backend" are optional.
+    """
+    with open(filename, "r") as file:
+        config = json.load(file)
+    zones: dict[str, ZoneConfig] = {}
+    for name, zone in config["zones"].items():
+        bl_lat, bl_lon, tr_lat, tr_lon = zone["zone"]
+        zones[name] = ZoneConfig(
+            Zone(Point(bl_lat, bl_lon), Point(tr_lat, tr_lon)),
+            zone["segment_data"],
+            zone.get("clusters"),
+            zone.get("epsilon"),
+            zone.get("backend", DEFAULT_BACKEND),
+        )
+    return zones, config["monument_data"]
+
+
+def build_zone(config: ZoneConfig, monument_data: str) -> WarmZone:
+    """
+    Builds the graph of a zone from its local segment data and assigns the monuments of the zone to it.
+    Nothing is downloaded: the service only works with data that is already on disk.
+    """
+    if not is_download_complete(config.segment_data):
+        raise FileNotFoundError(f"No complete segment data in {config.segment_data}")
+    segments = load_segments(config.segment_data)
+    graph = get_cached_graph(
+        config.segment_data, segments, config.clusters, config.epsilon, config.backend
+    )
+    index = build_node_index(graph)
+    assignment = assign_monuments(graph, load_monuments(config.zone, monument_data), index)
+    return WarmZone(graph, index, assignment)
+
+
+def get_zone(state: ServiceState, name: str) -> WarmZone:
+    """
+    Returns the warm graph of the zone 'name', building it if it is not in memory. When there are more than
+    'max_zones' zones in memory, the least recently used one is forgotten.
+    Pre: name is one of the zones of the service
+    """
+    with state.lock:
+        if name in state.warm:
+            state.warm.move_to_end(name)
+            return state.warm[name]
+        zone_lock = state.zone_locks.setdefault(name, threading.Lock())
+    with zone_lock:
+        with state.lock:
+            # another request could have built it while we were waiting
+            if name in state.warm:
+                return state.warm[name]
+        warm = build_zone(state.zones[name], state.monument_data)
+        with state.lock:
+            state.warm[name] = warm
+            while len(state.warm) > state.max_zones:
+                state.warm.popitem(last=False)
+    return warm
+
+
+def find_zone_routes(state: ServiceState, name: str, start: Point) -> Routes:
+    """
+    Finds the shortest routes from the point 'start' to all the monuments of the zone 'name'.
+    Only reads the graph of the zone, so it can run for many requests at the same time.
+    """
+    warm = get_zone(state, name)
+    start_node = closest_nodes(warm.index, [start])[0]
+    return find_shortest_routes(warm.graph, start_node, warm.assignment)
+
+
+def routes_to_json(routes: Routes) -> dict:
+    """
+    Returns the routes in a format that can be sent as JSON, with points as [lat, lon]
+    """
+    return {
+        "routes": [
+            {
+                "total_dist": route.total_dist,
+                "start": [route.start.lat, route.start.lon],
+                "end": [route.end.lat, route.end.lon],
+                "path": [[point.lat, point.lon] for point in route.path],
+            }
+            for route in routes
+        ]
+    }
+
+
+def make_handler(state: ServiceState) -> type[BaseHTTPRequestHandler]:
+    """
+    Returns an HTTP request handler that answers with the state of the service:
+        GET /zones                               -> names of the zones served
+        GET /routes?zone=NAME&lat=LAT&lon=LON    -> routes from (LAT, LON) to the monuments of the zone
+    """
+
+    class RoutingHandler(BaseHTTPRequestHandler):
+        def send_json(self, status: int, content: dict) -> None:
+            body = json.dumps(content).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/zones":
+                self.send_json(200, {"zones": sorted(state.zones)})
+                return
+            if url.path != "/routes":
+                self.send_json(404, {"error": f"Unknown path {url.path}"})
+                return
+            try:
+                name = query["zone"][0]
+                start = Point(float(query["lat"][0]), float(query["lon"][0]))
+            except (KeyError, ValueError):
+                self.send_json(400, {"error": "Expected parameters zone, lat and lon"})
+                return
+            if not (math.isfinite(start.lat) and math.isfinite(start.lon)):
+                self.send_json(400, {"error": "lat and lon must be finite numbers"})
+                return
+            if name not in state.zones:
+                self.send_json(404, {"error": f"Unknown zone {name}"})
+                return
+            try:
+                routes = find_zone_routes(state, name, start)
+            except FileNotFoundError as e:
+                self.send_json(404, {"error": str(e)})
+                return
+            except Exception as e:
+                # the client always gets an answer, even if the data of the zone cannot be used
+                self.log_error("Could not find the routes of zone %s: %r", name, e)
+                self.send_json(500, {"error": f"Could not find the routes of zone {name}: {e}"})
+                return
+            self.send_json(200, routes_to_json(routes))
+
+    return RoutingHandler
+
+
+def serve(state: ServiceState, host: str, port: int) -> None:
+    """
+    Answers route requests on host:port until the process is stopped. Every request runs in its own thread.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    print(f"Serving routes for {len(state.zones)} zones on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Serve routes to monuments for the zones in a configuration file."
+    )
+    parser.add_argument("config", help="JSON file with the zones to serve")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-zones", type=int, default=MAX_ZONES)
+    arguments = parser.parse_args()
+    zones, monument_data = read_config(arguments.config)
+    serve(
+        ServiceState(zones, monument_data, arguments.max_zones),
+        arguments.host,
+        arguments.port,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+import json
+import os
+import threading
+import instrumentation
+from instrumentation import configure, stage
+
+
+def test_concurrent_profiled_stages(tmp_path) -> None:
+    """
+    Two stages that are profiled from two threads at the same time must both finish and be reported:
+    one of them with its profile and the other one without it.
+    """
+    report_file = str(tmp_path / "stages.jsonl")
+    configure(report_file, str(tmp_path / "profiles"))
+    both_started = threading.Barrier(2)
+    errors: list[BaseException] = []
+
+    def run(name: str) -> None:
+        try:
+            with stage(name):
+                both_started.wait(timeout=10)
+                sum(i * i for i in range(10000))
+                both_started.wait(timeout=10)  # neither stage ends before the other one has started
+        except BaseException as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(name,)) for name in ("first", "second")]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        configure()
+
+    assert errors == []
+    with open(report_file) as file:
+        records = [json.loads(line) for line in file]
+    assert sorted(record["stage"] for record in records) == ["first", "second"]
+    profiles = [record["profile"] for record in records]
+    assert profiles.count(None) == 1
+    assert all(os.path.exists(profile) for profile in profiles if profile is not None)
+    # the next stage can be profiled again
+    assert not instrumentation.profiling_lock.locked()
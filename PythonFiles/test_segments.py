@@ -0,0 +1,132 @@
+import threading
+import numpy as np
+import pytest
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+from urllib.parse import parse_qs, urlparse
+import segments
+from geographical import Point, Zone
+from segments import download_segments, is_download_complete, parse_segments
+
+
+ZONE = Zone(Point(41.0, 2.0), Point(41.1, 2.1))
+PAGES = 5  # pages with tracks before the first empty one
+POINTS = 4  # points of the track of every page
+
+
+def page_points(page: int) -> list[tuple[float, float]]:
+    """
+    Returns the latitude and longitude of the points of the track of the page, which are different for every page
+    """
+    return [(41.0 + page * 0.001 + i * 0.0001, 2.0 + i * 0.0001) for i in range(POINTS)]
+
+
+def page_gpx(page: int) -> bytes:
+    """
+    Returns the GPX content of the page: one track with one point every 10 seconds
+    """
+    points = "".join(
+        f'<trkpt lat="{lat}" lon="{lon}"><time>2020-01-01T10:00:{10 * i:02d}Z</time></trkpt>'
+        for i, (lat, lon) in enumerate(page_points(page))
+    )
+    return (
+        '<?xml version="1.0"?><gpx version="1.0" xmlns="http://www.topografix.com/GPX/1/0">'
+        f"<trk><trkseg>{points}</trkseg></trk></gpx>"
+    ).encode("utf-8")
+
+
+def expected_segments(pages: int) -> np.ndarray:
+    """
+    Returns the segments of the first 'pages' pages in page order
+    """
+    return np.array(
+        [
+            [*start, *end]
+            for page in range(pages)
+            for start, end in zip(page_points(page)[:-1], page_points(page)[1:])
+        ]
+    )
+
+
+class FakeTrackpoints:
+    """
+    Stand-in of the trackpoints API: pages 0..PAGES-1 have a track, page PAGES is empty and the pages after it have
+    tracks again (which must never be downloaded). The pages in 'failing' answer with an error once.
+    """
+
+    def __init__(self) -> None:
+        self.failing: set[int] = set()
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                page = int(parse_qs(urlparse(self.path).query)["page"][0])
+                with fake.lock:
+                    fail = page in fake.failing
+                    fake.failing.discard(page)
+                if fail:
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                if page == PAGES:
+                    content = b'<?xml version="1.0"?><gpx version="1.0"></gpx>'
+                else:
+                    content = page_gpx(page)
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format: str, *args: object) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/api/0.6/trackpoints"
+
+
+@pytest.fixture
+def trackpoints(monkeypatch: pytest.MonkeyPatch) -> Iterator[FakeTrackpoints]:
+    # the local server does not need to be protected from too many requests
+    monkeypatch.setattr(segments, "REQUESTS_PER_SECOND", 1000)
+    fake = FakeTrackpoints()
+    thread = threading.Thread(target=fake.server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield fake
+    finally:
+        fake.server.shutdown()
+        fake.server.server_close()
+
+
+def test_download_in_page_order(trackpoints: FakeTrackpoints, tmp_path) -> None:
+    """
+    The pages are downloaded several at a time, but their segments are written in page order and nothing after
+    the first empty page is written
+    """
+    filename = str(tmp_path / "segments.txt")
+    download_segments(ZONE, filename, pages_in_flight=3, base_url=trackpoints.url)
+    assert is_download_complete(filename)
+    np.testing.assert_array_equal(parse_segments(filename), expected_segments(PAGES))
+
+
+def test_resume_after_failure(trackpoints: FakeTrackpoints, tmp_path) -> None:
+    """
+    A download that fails at a page raises the error, keeps the pages before it and resumes from it, ending
+    with the same file as a download that never failed
+    """
+    clean = str(tmp_path / "clean.txt")
+    download_segments(ZONE, clean, pages_in_flight=3, base_url=trackpoints.url)
+
+    filename = str(tmp_path / "resumed.txt")
+    trackpoints.failing = {2}
+    with pytest.raises(requests.HTTPError):
+        download_segments(ZONE, filename, pages_in_flight=3, base_url=trackpoints.url)
+    assert not is_download_complete(filename)
+    np.testing.assert_array_equal(parse_segments(filename), expected_segments(2))
+
+    download_segments(ZONE, filename, pages_in_flight=3, base_url=trackpoints.url)
+    assert is_download_complete(filename)
+    with open(clean, "rb") as file, open(filename, "rb") as resumed:
+        assert resumed.read() == file.read()
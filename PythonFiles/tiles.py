@@ -0,0 +1,96 @@
+import os
+import math
+from typing import TypeAlias
+import numpy as np
+from numpy import ndarray
+from segments import (
+    TRACKPOINTS_URL,
+    SegmentArray,
+    Segments,
+    download_segments,
+    drop_duplicate_segments,
+    is_download_complete,
+    load_segments,
+    zone_mask,
+)
+from geographical import Point, Zone
+from instrumentation import stage
+
+
+TILE_DIR = "segment_tiles"  # directory where the segments of every tile are kept between executions
+TILE_SIZE = 0.1  # side of the tiles in degrees (~11km of latitude)
+TILE_MARGIN = 0.001  # degrees (~100m) each tile is extended by, so segments crossing a tile border are not lost
+
+Tile: TypeAlias = tuple[int, int]  # [latitude index, longitude index] of a tile in the grid
+
+
+def tile_index(coordinate: float) -> int:
+    """
+    Returns the index in the grid of the tiles that contain the latitude or longitude 'coordinate'
+    """
+    # rounding first keeps coordinates on a tile border (like 40.5) from falling in the previous tile
+    return math.floor(round(coordinate / TILE_SIZE, 9))
+
+
+def covering_tiles(zone: Zone) -> list[Tile]:
+    """
+    Returns the tiles that cover the zone, row by row
+    """
+    return [
+        (i, j)
+        for i in range(tile_index(zone.bottom_left.lat), tile_index(zone.top_right.lat) + 1)
+        for j in range(tile_index(zone.bottom_left.lon), tile_index(zone.top_right.lon) + 1)
+    ]
+
+
+def tile_zone(tile: Tile) -> Zone:
+    """
+    Returns the zone whose segments are downloaded for the tile: the tile extended by TILE_MARGIN on every side
+    """
+    i, j = tile
+    return Zone(
+        Point(round(i * TILE_SIZE - TILE_MARGIN, 7), round(j * TILE_SIZE - TILE_MARGIN, 7)),
+        Point(
+            round((i + 1) * TILE_SIZE + TILE_MARGIN, 7),
+            round((j + 1) * TILE_SIZE + TILE_MARGIN, 7),
+        ),
+    )
+
+
+def tile_filename(tile: Tile, tile_dir: str = TILE_DIR) -> str:
+    """
+    Returns the name of the segment data file of the tile
+    """
+    i, j = tile
+    return os.path.join(tile_dir, f"{i}_{j}.txt")
+
+
+def get_tile(
+    tile: Tile, tile_dir: str = TILE_DIR, base_url: str = TRACKPOINTS_URL
+) -> Segments:
+    """
+    Returns the segments of the tile, downloading them (or finishing their download) only if they are not
+    in the tile directory yet
+    """
+    filename = tile_filename(tile, tile_dir)
+    if not is_download_complete(filename):
+        os.makedirs(tile_dir, exist_ok=True)
+        with stage("download", file=filename):
+            download_segments(tile_zone(tile), filename, base_url=base_url)
+    with stage("load", file=filename):
+        return load_segments(filename)
+
+
+def get_zone_segments(
+    zone: Zone, tile_dir: str = TILE_DIR, base_url: str = TRACKPOINTS_URL
+) -> Segments:
+    """
+    Returns the segments of the zone, assembled from the tiles that cover it. Only the tiles that were never
+    downloaded are downloaded, so zones that overlap share the segments they have in common.
+    Segments near a tile border are in both tiles, and are only returned once.
+    """
+    parts: list[ndarray] = []
+    for tile in covering_tiles(zone):
+        coords = get_tile(tile, tile_dir, base_url).coords
+        parts.append(np.asarray(coords[zone_mask(coords, zone)]))
+    return SegmentArray(drop_duplicate_segments(np.concatenate(parts)))
@@ -1,29 +1,70 @@
 import networkx as nx
 from staticmap import *
-import simplekml
+from kmlwriter import KMLWriter, kml_color
+from rendering import new_static_map
+from instrumentation import instrumented
 import platform
 import subprocess
 import os
+from io import BytesIO
+from typing import Optional
+from PIL import Image
+
+
+def is_headless() -> bool:
+    """
+    Returns True iff there is no screen to show the maps on, like in a server without a graphical session
+    """
+    if platform.system() in ("Windows", "Darwin"):
+        return False
+    return not (os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
 
 
 def display_map(filename: str) -> None:
     """
-    Automatically opens the PNG file 'filename' containing a map
+    Automatically opens the PNG file 'filename' containing a map. The viewer is started in the background,
+    so this never waits for it to be closed.
     """
-    if platform.system() == "Windows":
-        os.startfile(filename)
-    elif platform.system() == "Darwin":  # macOS
-        subprocess.run(["open", filename])
-    else:  # Linux and other Unix-like systems
-        subprocess.run(["xdg-open", filename])
+    try:
+        if platform.system() == "Windows":
+            os.startfile(filename)
+        elif platform.system() == "Darwin":  # macOS
+            subprocess.Popen(["open", filename])
+        else:  # Linux and other Unix-like systems
+            subprocess.Popen(
+                ["xdg-open", filename],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+    except OSError as e:
+        print(f"Could not open {filename}: {e}")
 
 
-def export_graph_PNG(graph: nx.Graph, filename: str) -> None:
+def save_map(image: Image.Image, filename: Optional[str], display: bool) -> Optional[bytes]:
+    """
+    Saves the rendered map 'image' to the PNG file "filename" and shows it if 'display' is True and there is
+    a screen. If filename is None nothing is written and the PNG is returned as bytes instead.
     """
-    Export a networkx graph to a PNG file "filename" using staticmap.
+    if filename is None:
+        buffer = BytesIO()
+        image.save(buffer, format="png")
+        return buffer.getvalue()
+    image.save(filename, format="png")
+    if display and not is_headless():
+        display_map(filename)
+    return None
+
+
+@instrumented
+def export_graph_PNG(
+    graph: nx.Graph, filename: Optional[str], display: bool = True
+) -> Optional[bytes]:
+    """
+    Export a networkx graph to a PNG file "filename" using staticmap, and show it if 'display' is True.
+    If filename is None the PNG is returned as bytes instead (see save_map).
     Pre: all nodes of the graoh have a "coord" attribute
     """
-    static_map = StaticMap(width=800, height=600)
+    static_map = new_static_map()
     # Iterate over nodes and add them to the map
     for node in graph.nodes():
         lat = graph.nodes[node]["coord"].lat  # typeerror!!!
@@ -37,25 +78,21 @@ def export_graph_PNG(graph: nx.Graph, filename: str) -> None:
         line = Line([(lon1, lat1), (lon2, lat2)], "royalblue", width=2)
         static_map.add_line(line)
     # Save and display the map as an image
-    static_map.render().save(filename)
-    display_map(filename)
+    return save_map(static_map.render(), filename, display)
 
 
+@instrumented
 def export_graph_KML(graph: nx.Graph, filename: str) -> None:
     """
-    Export a networkx graph to a KML file "filename".
+    Export a networkx graph to a KML file "filename" (compressed as KMZ if its extension is .kmz).
+    The edges are written one by one as they are added.
     Pre: all nodes have a "coord" attribute
     """
-    kml = simplekml.Kml()
-    # iterate over edges and add them to the graph
-    for u, v in graph.edges():
-        u_lon, u_lat = graph.nodes[u]["coord"].lat, graph.nodes[u]["coord"].lon
-        v_lon, v_lat = graph.nodes[v]["coord"].lat, graph.nodes[v]["coord"].lon
-        line = kml.newlinestring(
-            name=f"{u} to {v}", coords=[(u_lat, u_lon), (v_lat, v_lon)]
-        )
-        line.style.linestyle.color = simplekml.Color.rgb(
-            173, 216, 230
-        )  # light blue colour
-    # save the .kml file
-    kml.save(filename)
+    with KMLWriter(filename) as kml:
+        # all the edges share the same light blue style
+        kml.add_style("edge", kml_color(173, 216, 230))
+        # iterate over edges and add them to the graph
+        for u, v in graph.edges():
+            u_lat, u_lon = graph.nodes[u]["coord"].lat, graph.nodes[u]["coord"].lon
+            v_lat, v_lon = graph.nodes[v]["coord"].lat, graph.nodes[v]["coord"].lon
+            kml.add_linestring(f"{u} to {v}", [(u_lon, u_lat), (v_lon, v_lat)], "edge")